@@ -7,6 +7,11 @@ function verify(meta, data){
   const body = Buffer.from(meta.ts + '|' + JSON.stringify(data));
   const calc = crypto.createHmac('sha256', SECRET).update(body).digest('base64');
   if(calc !== meta.sig) throw new Error('Invalid HMAC');
+  if(meta.ext){ // per-user extras, signed separately over ts|sig|ext
+    const ext = Buffer.from(meta.ts + '|' + meta.sig + '|' + JSON.stringify(meta.ext));
+    const calcExt = crypto.createHmac('sha256', SECRET).update(ext).digest('base64');
+    if(calcExt !== meta.ext_sig) throw new Error('Invalid ext HMAC');
+  }
 }
 
 const ws = new WebSocket('ws://localhost:9000/ws/orders?api_key=demo');
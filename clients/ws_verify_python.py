@@ -5,6 +5,10 @@ def verify(meta, data):
     body=(meta['ts'] + '|' + json.dumps(data, separators=(',',':'))).encode()
     calc=base64.b64encode(hmac.new(SECRET, body, hashlib.sha256).digest()).decode()
     assert calc==meta['sig'], "Invalid HMAC"
+    if 'ext' in meta:  # per-user extras (throttle_remaining, exposure_snapshot), signed separately
+        ext=(meta['ts'] + '|' + meta['sig'] + '|' + json.dumps(meta['ext'], separators=(',',':'))).encode()
+        calc=base64.b64encode(hmac.new(SECRET, ext, hashlib.sha256).digest()).decode()
+        assert calc==meta['ext_sig'], "Invalid ext HMAC"
 
 async def run():
     async with websockets.connect("ws://localhost:9000/ws/orders?api_key=demo") as ws:
@@ -0,0 +1,3 @@
+"""
+Matching engine benchmark suite (synthetic EPEX intraday flow, in-process exchange)
+"""
@@ -0,0 +1,95 @@
+"""
+Synthetic EPEX intraday order flow for the matching engine benchmark
+Quarter-hour products, passive price ladders, cancels and crossing orders at configurable rates.
+"""
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+
+class FlowConfig:
+    """Knobs for the generated flow (rates are fractions of all events)"""
+
+    def __init__(self, markets: Optional[List[str]] = None, products: int = 96, ladder_steps: int = 5,
+                 tick: float = 0.1, cancel_rate: float = 0.25, amend_rate: float = 0.05, cross_rate: float = 0.1,
+                 mid_price: float = 85.0, seed: int = 42, day: str = "2025-10-25"):
+        self.markets = markets or ["EPEX_AT_INTRADAY_15MIN"]
+        self.products = products
+        self.ladder_steps = ladder_steps
+        self.tick = tick
+        self.cancel_rate = cancel_rate
+        self.amend_rate = amend_rate
+        self.cross_rate = cross_rate
+        self.mid_price = mid_price
+        self.seed = seed
+        self.day = day
+
+    def as_dict(self) -> Dict:
+        return dict(self.__dict__)
+
+
+def quarter_hours(day: str, n: int = 96) -> List[tuple]:
+    start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+    out = []
+    for i in range(n):
+        s = start + timedelta(minutes=15 * i)
+        out.append((s.isoformat().replace("+00:00", "Z"), (s + timedelta(minutes=15)).isoformat().replace("+00:00", "Z")))
+    return out
+
+
+class IntradayFlow:
+    """Generates a deterministic stream of events:
+
+    {"op": "new", "order_id", "order": {OrderIn fields}}
+    {"op": "cancel", "order_id"}
+    {"op": "amend", "order_id", "qty"}  (quantity reduction, keeps priority)
+
+    Passive orders are quoted on a ladder around a per-product mid that follows a
+    random walk; crossing orders lift/hit through the top of book.
+    """
+
+    def __init__(self, cfg: FlowConfig):
+        self.cfg = cfg
+        self.rng = random.Random(cfg.seed)
+        self.products = quarter_hours(cfg.day, cfg.products)
+        self.mid: Dict[tuple, float] = {}
+        self.live: List[tuple] = []  # (order_id, qty) of passive orders we may cancel/amend
+
+    def _order(self, market: str, product: tuple, side: str, price: float, qty: float) -> Dict:
+        return {"market": market, "delivery_start": product[0], "delivery_end": product[1], "side": side,
+                "quantity_mwh": round(qty, 1), "limit_price_eur_mwh": round(price, 2),
+                "order_type": "LIMIT", "time_in_force": "GFD"}
+
+    def events(self, n: int) -> Iterator[Dict]:
+        cfg = self.cfg; rng = self.rng
+        for _ in range(n):
+            x = rng.random()
+            if self.live and x < cfg.cancel_rate:
+                oid, _ = self.live.pop(rng.randrange(len(self.live)))
+                yield {"op": "cancel", "order_id": oid}
+                continue
+            if self.live and x < cfg.cancel_rate + cfg.amend_rate:
+                i = rng.randrange(len(self.live)); oid, qty = self.live[i]
+                new_qty = max(0.1, round(qty / 2, 1))
+                self.live[i] = (oid, new_qty)
+                yield {"op": "amend", "order_id": oid, "qty": new_qty}
+                continue
+            market = rng.choice(cfg.markets)
+            product = rng.choice(self.products)
+            key = (market, product)
+            mid = self.mid.get(key, cfg.mid_price) + rng.gauss(0, cfg.tick)
+            self.mid[key] = mid
+            side = "BUY" if rng.random() < 0.5 else "SELL"
+            sign = 1 if side == "BUY" else -1
+            oid = uuid.UUID(int=rng.getrandbits(128)).hex
+            if x < cfg.cancel_rate + cfg.amend_rate + cfg.cross_rate:
+                # Aggressive: priced through several ladder steps of the opposite side
+                price = mid + sign * cfg.tick * (cfg.ladder_steps + 1)
+                yield {"op": "new", "order_id": oid, "order": self._order(market, product, side, price, rng.uniform(0.5, 5.0))}
+            else:
+                step = rng.randint(1, cfg.ladder_steps)
+                price = mid - sign * cfg.tick * step
+                qty = rng.uniform(0.5, 3.0)
+                self.live.append((oid, round(qty, 1)))
+                yield {"op": "new", "order_id": oid, "order": self._order(market, product, side, price, qty)}
@@ -0,0 +1,215 @@
+"""
+Matching Engine Benchmark - runs the exchange in-process against a temp SQLite file
+and fakeredis, feeds it synthetic intraday flow and reports throughput, latency
+percentiles and allocations. Results can be saved as a baseline and compared later.
+
+Usage (from exchange/):
+    python -m bench.run --events 5000
+    python -m bench.run --events 5000 --save-baseline bench/baseline.json
+    python -m bench.run --events 5000 --baseline bench/baseline.json   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.flow import FlowConfig, IntradayFlow
+from loop_lag import LoopLagProbe
+
+USER_KEY = "bench"
+
+
+def load_exchange(workdir: str, markets: List[str]):
+    """Import server.py wired to a temp SQLite DB, temp state dir, permissive policy and fakeredis"""
+    import fakeredis
+    import redis
+    import redis.asyncio
+    policy = os.path.join(workdir, "policy.yaml")
+    with open(policy, "w") as f:
+        json.dump({"version": "bench", "per_market_rps": {m: 10 ** 9 for m in markets}}, f)
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "exchange.db")
+    os.environ["EXCHANGE_STATE_DIR"] = os.path.join(workdir, "state")
+    os.environ["POLICY_PATH"] = policy
+    redis.Redis = fakeredis.FakeRedis
+    redis.asyncio.Redis = fakeredis.FakeAsyncRedis
+    import server
+    return server
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50_ms": 0.0, "p99_ms": 0.0, "p999_ms": 0.0, "max_ms": 0.0}
+    s = sorted(samples); n = len(s)
+    pick = lambda q: s[min(n - 1, int(q * n))] * 1000.0
+    return {"p50_ms": round(pick(0.50), 4), "p99_ms": round(pick(0.99), 4), "p999_ms": round(pick(0.999), 4), "max_ms": round(s[-1] * 1000.0, 4)}
+
+
+def _engine_cmd(server, ev: Dict) -> tuple:
+    """Translate a flow event into (market, sequencer command)"""
+    if ev["op"] == "new":
+        o = server.OrderIn(**ev["order"])
+        return o.market, {"op": "new", "order_id": ev["order_id"], "user_key": USER_KEY, "order": o, "ts": datetime.utcnow().isoformat()}
+    book = server.ORDER_INDEX.get(ev["order_id"])
+    if book is None:
+        return None, None
+    if ev["op"] == "cancel":
+        return book.market, {"op": "cancel", "order_id": ev["order_id"], "user_key": USER_KEY}
+    return book.market, {"op": "amend", "order_id": ev["order_id"], "user_key": USER_KEY, "qty": ev["qty"], "price": None,
+                         "ts": datetime.utcnow().isoformat()}
+
+
+async def run_engine(server, events: List[Dict], concurrency: int) -> Dict:
+    """Submit straight to the market sequencers (matching + journal + SQLite, no HTTP)"""
+    lat: List[float] = []; errors = 0
+    it = iter(events)
+    probe = LoopLagProbe(window=10 ** 6).start()
+
+    async def worker():
+        nonlocal errors
+        for ev in it:
+            market, cmd = _engine_cmd(server, ev)
+            if cmd is None:
+                continue
+            t0 = time.perf_counter()
+            try:
+                await server.get_sequencer(market, server.process_batch).submit(cmd)
+            except Exception:
+                errors += 1
+            lat.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - t0
+    probe.stop()
+    return {"events": len(lat), "errors": errors, "elapsed_s": round(elapsed, 4),
+            "orders_per_s": round(len(lat) / elapsed, 1) if elapsed else 0.0, **percentiles(lat), "loop_lag": probe.stats()}
+
+
+async def run_rest(server, events: List[Dict], concurrency: int) -> Dict:
+    """Drive the REST order path (POST/DELETE/PATCH /orders) through an in-process ASGI client"""
+    import httpx
+    lat: List[float] = []; errors = 0
+    it = iter(events)
+    probe = LoopLagProbe(window=10 ** 6).start()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench") as client:
+
+        async def worker():
+            nonlocal errors
+            for ev in it:
+                t0 = time.perf_counter()
+                if ev["op"] == "new":
+                    resp = await client.post("/orders", json=ev["order"])
+                    if resp.status_code == 200:
+                        # The flow refers to its own ids; map them onto exchange-assigned ones
+                        ids[ev["order_id"]] = resp.json()["order_id"]
+                else:
+                    oid = ids.get(ev["order_id"])
+                    if oid is None:
+                        continue
+                    if ev["op"] == "cancel":
+                        resp = await client.delete(f"/orders/{oid}")
+                    else:
+                        resp = await client.patch(f"/orders/{oid}", json={"quantity_mwh": ev["qty"]})
+                lat.append(time.perf_counter() - t0)
+                if resp.status_code >= 400:
+                    errors += 1
+
+        ids: Dict[str, str] = {}
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+    probe.stop()
+    return {"events": len(lat), "errors": errors, "elapsed_s": round(elapsed, 4),
+            "orders_per_s": round(len(lat) / elapsed, 1) if elapsed else 0.0, **percentiles(lat), "loop_lag": probe.stats()}
+
+
+async def measure_allocations(server, events: List[Dict]) -> Dict:
+    """Allocated blocks/bytes per sequenced event, measured on a separate short pass"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    res = await run_engine(server, events, 1)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    blocks = sum(max(0, d.count_diff) for d in diff); size = sum(max(0, d.size_diff) for d in diff)
+    n = max(1, res["events"])
+    return {"events": res["events"], "alloc_blocks_per_event": round(blocks / n, 2), "alloc_kib_per_event": round(size / n / 1024.0, 3)}
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Regressions beyond `tolerance` (fraction) in throughput or tail latency"""
+    out = []
+    for mode in ("engine", "rest"):
+        cur, base = result.get(mode), baseline.get(mode)
+        if not cur or not base:
+            continue
+        if cur["orders_per_s"] < base["orders_per_s"] * (1 - tolerance):
+            out.append(f"{mode}: orders/s {cur['orders_per_s']} < baseline {base['orders_per_s']}")
+        for k in ("p50_ms", "p99_ms"):
+            if cur[k] > base[k] * (1 + tolerance):
+                out.append(f"{mode}: {k} {cur[k]} > baseline {base[k]}")
+    return out
+
+
+async def main_async(args) -> Dict:
+    cfg = FlowConfig(markets=args.markets.split(","), products=args.products, ladder_steps=args.ladder_steps,
+                     cancel_rate=args.cancel_rate, amend_rate=args.amend_rate, cross_rate=args.cross_rate, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix="pho_bench_")
+    server = load_exchange(workdir, cfg.markets)
+    await server.BESS.publish(50.0, 0.0, 25.0)
+    flow = IntradayFlow(cfg)
+    result = {"timestamp": datetime.utcnow().isoformat(), "python": platform.python_version(),
+              "config": {**cfg.as_dict(), "events": args.events, "concurrency": args.concurrency}}
+    if args.mode in ("engine", "both"):
+        result["engine"] = await run_engine(server, list(flow.events(args.events)), args.concurrency)
+    if args.mode in ("rest", "both"):
+        result["rest"] = await run_rest(server, list(flow.events(args.events)), args.concurrency)
+    if args.allocations:
+        result["allocations"] = await measure_allocations(server, list(flow.events(args.allocations)))
+    result["resting_orders"] = len(server.ORDER_INDEX)
+    return result
+
+
+def main():
+    p = argparse.ArgumentParser(description="Phoenyra matching engine benchmark")
+    p.add_argument("--events", type=int, default=5000)
+    p.add_argument("--mode", choices=["engine", "rest", "both"], default="both")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--markets", default="EPEX_AT_INTRADAY_15MIN,EPEX_DE_INTRADAY_15MIN")
+    p.add_argument("--products", type=int, default=96)
+    p.add_argument("--ladder-steps", type=int, default=5)
+    p.add_argument("--cancel-rate", type=float, default=0.25)
+    p.add_argument("--amend-rate", type=float, default=0.05)
+    p.add_argument("--cross-rate", type=float, default=0.1)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--allocations", type=int, default=2000, help="events in the tracemalloc pass (0 disables)")
+    p.add_argument("--save-baseline", help="write results to this JSON file")
+    p.add_argument("--baseline", help="compare against this JSON file and exit 1 on regression")
+    p.add_argument("--tolerance", type=float, default=0.2)
+    args = p.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print(json.dumps(result, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
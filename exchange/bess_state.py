@@ -0,0 +1,129 @@
+"""
+BESS State - In-process telemetry snapshot (SoC, power, temperature) shared via Redis pub/sub
+Writers publish a versioned snapshot; every exchange process keeps the newest one in memory,
+so order gating reads no network. With BESS_STALE_S set, telemetry older than that fails safe.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from prometheus_client import Gauge
+
+CHANNEL = "telemetry:bess"
+STATE_KEY = "telemetry:state"      # last snapshot, read once at startup
+VERSION_KEY = "telemetry:version"
+# Opt-in (0 = off): only meaningful with a periodic source (Modbus / MQTT / REST poller), e.g. three
+# missed updates (3 x BESS_UPDATE_INTERVAL). Manual telemetry from the dashboard form never refreshes.
+BESS_STALE_S = float(os.getenv("BESS_STALE_S", "0"))
+
+G_BESS_VERSION = Gauge("pho_bess_state_version", "Version of the BESS telemetry snapshot held in memory")
+G_BESS_AGE = Gauge("pho_bess_state_age_seconds", "Age of the BESS telemetry snapshot held in memory")
+
+
+class BessState(NamedTuple):
+    version: int
+    soc: float
+    power: float
+    temp: float
+    ts: float          # wall clock of the measurement (publisher)
+    received: float    # monotonic time of the measurement as seen by this process
+
+    def to_json(self) -> str:
+        return json.dumps({"v": self.version, "soc": self.soc, "power": self.power, "temp": self.temp, "ts": self.ts})
+
+    @classmethod
+    def from_json(cls, raw) -> "BessState":
+        d = json.loads(raw); ts = float(d["ts"])
+        # Age counts from the measurement, so a snapshot left in Redis by a dead publisher is stale
+        received = time.monotonic() - max(0.0, time.time() - ts)
+        return cls(int(d["v"]), float(d["soc"]), float(d["power"]), float(d["temp"]), ts, received)
+
+
+class BessStateCache:
+    """Current BessState of this process, refreshed from the Redis channel by a subscriber task"""
+
+    def __init__(self, redis, on_update: Optional[Callable[[BessState], None]] = None):
+        self.r = redis
+        self.on_update = on_update
+        self.current: Optional[BessState] = None  # None: no telemetry received yet
+        self.task: Optional[asyncio.Task] = None
+
+    def apply(self, st: BessState) -> bool:
+        """Swap in `st` unless an equal or newer snapshot is already held. Snapshots are ordered by
+        measurement time, then version: the INCR counter restarts at 1 when Redis loses its data,
+        and a newer measurement must not be dropped for that"""
+        cur = self.current
+        if cur is not None and (st.ts, st.version) <= (cur.ts, cur.version): return False
+        self.current = st
+        G_BESS_VERSION.set(st.version)
+        if self.on_update: self.on_update(st)
+        return True
+
+    def age(self) -> Optional[float]:
+        cur = self.current
+        return None if cur is None else time.monotonic() - cur.received
+
+    def stale(self) -> bool:
+        """True once received telemetry is older than BESS_STALE_S (never if disabled or before the first update)"""
+        if BESS_STALE_S <= 0: return False
+        age = self.age()
+        return age is not None and age > BESS_STALE_S
+
+    async def publish(self, soc: float, power: float, temp: float) -> BessState:
+        """Assign the next version, store the snapshot and broadcast it to all exchange processes"""
+        version = await self.r.incr(VERSION_KEY)
+        st = BessState(int(version), float(soc), float(power), float(temp), time.time(), time.monotonic())
+        async with self.r.pipeline(transaction=False) as p:
+            p.set(STATE_KEY, st.to_json())
+            p.mset({"telemetry:soc": st.soc, "telemetry:power": st.power, "telemetry:temp": st.temp})
+            p.publish(CHANNEL, st.to_json())
+            await p.execute()
+        self.apply(st)  # the publishing process does not wait for its own message
+        return st
+
+    def start(self) -> "BessStateCache":
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel(); self.task = None
+
+    async def _run(self):
+        backoff = 0.5
+        while True:
+            ps = self.r.pubsub()
+            try:
+                await ps.subscribe(CHANNEL)
+                # Snapshot after subscribing: nothing published in between is missed
+                raw = await self.r.get(STATE_KEY)
+                if raw: self.apply(BessState.from_json(raw))
+                backoff = 0.5
+                while True:
+                    msg = await ps.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg is not None and msg.get("type") == "message":
+                        self.apply(BessState.from_json(msg["data"]))
+                    age = self.age()
+                    if age is not None: G_BESS_AGE.set(age)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WARNING: BESS telemetry subscription lost ({e}), retrying in {backoff}s")
+                await asyncio.sleep(backoff); backoff = min(backoff * 2, 10.0)
+            finally:
+                try: await ps.reset()
+                except Exception: pass
+
+
+def limits(st: Optional[BessState], stale: bool) -> Tuple[bool, bool, float, float, float]:
+    """SoC gates and throttle scale: (allow_buy, allow_sell, rps_scale, soc, temp)"""
+    if st is None:
+        soc, temp = 100.0, 25.0  # no telemetry yet: same defaults as before the state cache
+    elif stale:
+        return False, False, 0.5, st.soc, st.temp  # fail safe: no new orders on outdated SoC
+    else:
+        soc, temp = st.soc, st.temp
+    return soc >= 15.0, soc <= 90.0, (0.5 if temp > 40.0 else 1.0), soc, temp
@@ -0,0 +1,86 @@
+"""
+DB Executor - Dedicated thread(s) for blocking SQLite work, awaited from the event loop
+Each executor thread opens its own connection; submitted callables get it as first argument
+and run there, so commits and queries never stall WebSocket traffic or other requests.
+
+Connections run in WAL mode (readers never block the writer and vice versa) with
+synchronous=NORMAL, a larger page cache, mmap I/O and a per-connection statement cache.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+
+from prometheus_client import Gauge, Histogram
+
+H_DB_CALL = Histogram("pho_db_call_seconds", "Time spent per call on a DB executor thread", ["executor"],
+                      buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+G_DB_PENDING = Gauge("pho_db_pending", "Calls queued or running on a DB executor", ["executor"])
+
+SQLITE_CACHE_KIB = int(os.getenv("SQLITE_CACHE_KIB", "65536"))    # page cache per connection
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "256"))           # memory-mapped I/O window
+SQLITE_STMT_CACHE = int(os.getenv("SQLITE_STMT_CACHE", "256"))     # prepared statements kept per connection
+
+
+def connect(path: str, readonly: bool = False, timeout: float = 10.0, check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open a tuned connection; read-only ones cannot take the write lock at all"""
+    if readonly:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=timeout,
+                              cached_statements=SQLITE_STMT_CACHE, check_same_thread=check_same_thread)
+        con.execute("PRAGMA query_only=ON")
+    else:
+        con = sqlite3.connect(path, timeout=timeout, cached_statements=SQLITE_STMT_CACHE, check_same_thread=check_same_thread)
+        con.execute("PRAGMA journal_mode=WAL")  # persistent in the DB file, set by the first writer
+        con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KIB}")
+    con.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.row_factory = sqlite3.Row
+    return con
+
+
+class DBExecutor:
+    """ThreadPoolExecutor whose threads each own one sqlite3 connection (the pool)"""
+
+    def __init__(self, path: str, name: str = "db", workers: int = 1, timeout: float = 10.0, readonly: bool = False):
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self.readonly = readonly
+        self._local = threading.local()
+        self._cons: List[sqlite3.Connection] = []
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"pho-{name}")
+
+    def _con(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            # check_same_thread=False only so close() can release it after the pool stopped
+            con = self._local.con = connect(self.path, self.readonly, self.timeout, check_same_thread=False)
+            self._cons.append(con)
+        return con
+
+    def _call(self, fn: Callable[..., Any], args: tuple) -> Any:
+        t0 = time.perf_counter()
+        con = self._con()
+        try:
+            return fn(con, *args)
+        except BaseException:
+            if con.in_transaction: con.rollback()
+            raise
+        finally:
+            H_DB_CALL.labels(self.name).observe(time.perf_counter() - t0)
+            G_DB_PENDING.labels(self.name).dec()
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Run fn(con, *args) on an executor thread and await its result"""
+        G_DB_PENDING.labels(self.name).inc()
+        return await asyncio.get_running_loop().run_in_executor(self._pool, self._call, fn, args)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        for con in self._cons:
+            con.close()
+        self._cons.clear()
@@ -0,0 +1,144 @@
+"""
+History Export - Columnar bulk export of price history, trades and order book snapshots
+Rows are read in keyset pages on the read pool and encoded page by page (Arrow IPC stream,
+Parquet with one row group per page, or raw little-endian float64 rows), so an export range
+never sits in memory as a whole. pyarrow is optional; without it only `f64` is served.
+"""
+import io
+import itertools
+import json
+import math
+import os
+import sqlite3
+import sys
+from array import array
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from price_history import page_after
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: float64 export only
+    pa = pq = None
+
+EXPORT_PAGE_ROWS = int(os.getenv("EXPORT_PAGE_ROWS", "50000"))  # rows per page / record batch / row group
+FORMATS = ("arrow", "parquet", "f64")
+MEDIA_TYPES = {"arrow": "application/vnd.apache.arrow.stream", "parquet": "application/vnd.apache.parquet",
+               "f64": "application/octet-stream"}
+
+Page = Tuple[List[tuple], Optional[tuple]]  # rows, watermark to continue after (None: range exhausted)
+
+
+def iso_of(ts_ms: int) -> str:
+    """Epoch ms as the naive UTC isoformat used by the trades / orderbook_history `ts` columns"""
+    return datetime.fromtimestamp(ts_ms / 1000, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def ms_of(iso: str) -> int:
+    return int(datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _prices(con: sqlite3.Connection, market: str, end: int, after: tuple, limit: int, product: Optional[str]) -> Page:
+    rows = page_after(con, market, after[0], after[1], limit, end)
+    out = [(r["timestamp"], r["mark"], r["ema"], r["vwap"]) for r in rows]
+    if len(out) < limit: return out, None
+    return out, (rows[-1]["timestamp"], rows[-1]["id"])
+
+
+def _trades(con: sqlite3.Connection, market: str, end: int, after: tuple, limit: int, product: Optional[str]) -> Page:
+    ts, rid = after
+    rows = con.execute("SELECT rowid, ts, side, executed, price FROM trades WHERE market = ? AND ts >= ? AND ts < ? "
+                       "AND (ts > ? OR rowid > ?) ORDER BY ts, rowid LIMIT ?",
+                       (market, ts, iso_of(end), ts, rid, limit)).fetchall()
+    out = [(ms_of(r["ts"]), 1 if r["side"] == "BUY" else -1, r["executed"], r["price"]) for r in rows]
+    return out, (rows[-1]["ts"], rows[-1]["rowid"]) if len(rows) == limit else None
+
+
+def _book(con: sqlite3.Connection, market: str, end: int, after: tuple, limit: int, product: Optional[str]) -> Page:
+    # One output row per price level; a snapshot holds up to 2 x 50 levels (persist_book)
+    ts, rid = after; snaps = max(1, limit // 100)
+    sql = "SELECT id, ts, bids, asks FROM orderbook_history WHERE market = ? AND ts >= ? AND ts < ? AND (ts > ? OR id > ?)"
+    params: list = [market, ts, iso_of(end), ts, rid]
+    if product is not None: sql += " AND product = ?"; params.append(product)
+    rows = con.execute(sql + " ORDER BY ts, id LIMIT ?", params + [snaps]).fetchall()
+    out = []
+    for r in rows:
+        t = ms_of(r["ts"])
+        for side, levels in ((1, r["bids"]), (-1, r["asks"])):
+            out += [(t, side, i, p, q) for i, (p, q) in enumerate(json.loads(levels or "[]"))]
+    return out, (rows[-1]["ts"], rows[-1]["id"]) if len(rows) == snaps else None
+
+
+class Dataset(NamedTuple):
+    columns: Tuple[Tuple[str, str], ...]  # (name, arrow type name)
+    fetch: Callable[..., Page]
+    start: Callable[[int], tuple]          # export start (ms) -> initial watermark
+
+
+DATASETS: Dict[str, Dataset] = {
+    "prices": Dataset((("timestamp", "int64"), ("mark", "float64"), ("ema", "float64"), ("vwap", "float64")),
+                      _prices, lambda start: (start, -1)),
+    "trades": Dataset((("timestamp", "int64"), ("side", "int8"), ("quantity", "float64"), ("price", "float64")),
+                      _trades, lambda start: (iso_of(start), -1)),
+    "orderbook": Dataset((("timestamp", "int64"), ("side", "int8"), ("level", "int16"), ("price", "float64"),
+                          ("quantity", "float64")), _book, lambda start: (iso_of(start), -1)),
+}
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file for the pyarrow writers; drain() hands out what was written since the last call"""
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.pos = 0
+
+    def writable(self) -> bool: return True
+
+    def write(self, b) -> int:
+        self.parts.append(bytes(b)); self.pos += len(b)
+        return len(b)
+
+    def tell(self) -> int: return self.pos
+
+    def drain(self) -> bytes:
+        out = b"".join(self.parts); self.parts.clear()
+        return out
+
+
+def _f64(rows: List[tuple]) -> bytes:
+    try:
+        a = array("d", itertools.chain.from_iterable(rows))
+    except TypeError:  # NULL prices -> NaN
+        a = array("d", (math.nan if v is None else v for v in itertools.chain.from_iterable(rows)))
+    if sys.byteorder == "big": a.byteswap()
+    return a.tobytes()
+
+
+async def stream(run: Callable[..., Awaitable[Page]], dataset: str, market: str, start: int, end: int, fmt: str,
+                 product: Optional[str] = None) -> AsyncIterator[bytes]:
+    """Encoded chunks of `dataset` for [start, end) ms; `run` executes a page query on the read pool"""
+    ds = DATASETS[dataset]
+    sink = writer = schema = None
+    if fmt != "f64":
+        schema = pa.schema([(name, getattr(pa, t)()) for name, t in ds.columns])
+        sink = _Sink()
+        writer = pa.ipc.new_stream(sink, schema) if fmt == "arrow" else pq.ParquetWriter(sink, schema)
+    after: Optional[tuple] = ds.start(start)
+    try:
+        while after is not None:
+            rows, after = await run(ds.fetch, market, end, after, EXPORT_PAGE_ROWS, product)
+            if not rows: continue
+            if fmt == "f64":
+                yield _f64(rows); continue
+            batch = pa.record_batch([pa.array(col, f.type) for col, f in zip(zip(*rows), schema)], schema=schema)
+            if fmt == "arrow": writer.write_batch(batch)
+            else: writer.write_table(pa.Table.from_batches([batch]))
+            chunk = sink.drain()
+            if chunk: yield chunk
+    finally:
+        if writer is not None: writer.close()
+    if sink is not None:
+        chunk = sink.drain()  # Arrow end-of-stream marker / Parquet footer
+        if chunk: yield chunk
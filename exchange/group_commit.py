@@ -0,0 +1,139 @@
+"""
+Group Commit Writer - Batches the SQL records of many sequencer passes into one transaction
+Passes from all markets are queued; the writer commits every GROUP_COMMIT_MS or as soon as
+GROUP_COMMIT_MAX records are pending, and resolves each pass's future once it is durable.
+A failed group is retried pass by pass: a pass is already applied to the books and the journal,
+so its caller is never told it failed (that would invite resubmitting a live order).
+"""
+import asyncio
+import os
+import sqlite3
+import time
+from typing import Any, Callable, List, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from dbexec import DBExecutor
+
+# 0 = no linger: a group is whatever queued up while the previous commit was running
+GROUP_COMMIT_MS = float(os.getenv("GROUP_COMMIT_MS", "0"))
+GROUP_COMMIT_MAX = int(os.getenv("GROUP_COMMIT_MAX", "5000"))
+GROUP_COMMIT_RETRY_MAX_S = float(os.getenv("GROUP_COMMIT_RETRY_MAX_S", "5"))
+# Errors a retry cannot fix: the offending records are skipped instead of halting the writer
+_REJECTED = (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.InterfaceError)
+
+H_COMMIT_RECORDS = Histogram("pho_commit_batch_records", "SQL records per group commit",
+                             buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+H_COMMIT_PASSES = Histogram("pho_commit_batch_passes", "Sequencer passes made durable per group commit",
+                            buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+H_COMMIT_LATENCY = Histogram("pho_commit_latency_seconds", "Journal fsync + SQLite commit time per group",
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+G_COMMIT_PENDING = Gauge("pho_commit_pending_records", "SQL records waiting for the next group commit")
+G_COMMIT_HALTED = Gauge("pho_commit_halted", "1 while the writer retries a pass that failed to commit (commits stall)")
+C_COMMIT_FAULTS = Counter("pho_commit_faults_total", "Failed commits of a single pass: retried, or records skipped", ["kind"])
+
+Op = Tuple[str, tuple]
+
+
+class GroupCommitWriter:
+    """Single consumer of durability requests; commit(con, ops) runs on the DB executor thread"""
+
+    def __init__(self, db: DBExecutor, commit: Callable[[Any, List[Op]], None],
+                 max_delay_ms: float = GROUP_COMMIT_MS, max_records: int = GROUP_COMMIT_MAX):
+        self.db = db
+        self.commit = commit
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_records = max_records
+        self.pending = 0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def submit(self, ops: List[Op]) -> asyncio.Future:
+        """Queue one pass's records; the future resolves (or fails) when they are committed"""
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((ops, fut))
+        self.pending += len(ops)
+        G_COMMIT_PENDING.set(self.pending)
+        if self.pending >= self.max_records:
+            self._full.set()
+        return fut
+
+    async def flush(self):
+        """Wait until everything submitted so far is committed"""
+        await self.submit([])
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                await self._commit_group(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Last resort (a bug, not a DB error): the writer must outlive it or every later pass hangs
+                C_COMMIT_FAULTS.labels("writer").inc()
+                print(f"ERROR group commit writer: {e!r}")
+                for _, fut in batch:
+                    if not fut.done(): fut.set_exception(e)
+
+    async def _commit_group(self, batch: list):
+        # Linger briefly so concurrent passes (all markets) share one fsync + commit
+        if self.max_delay > 0 and self.pending < self.max_records:
+            self._full.clear()
+            try: await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError: pass
+        n = len(batch[0][0])
+        while n < self.max_records and not self.queue.empty():
+            item = self.queue.get_nowait(); batch.append(item); n += len(item[0])
+        ops = [op for item_ops, _ in batch for op in item_ops]
+        self.pending -= n
+        G_COMMIT_PENDING.set(self.pending)
+        t0 = time.perf_counter()
+        try:
+            await self.db.run(self.commit, ops)
+        except Exception as e:
+            # One bad pass must not fail the others (all markets): isolate them, in order
+            print(f"ERROR group commit of {len(batch)} passes failed ({e}), committing them one by one")
+            for item_ops, _ in batch:
+                await self._commit_pass(item_ops)
+        H_COMMIT_LATENCY.observe(time.perf_counter() - t0)
+        H_COMMIT_RECORDS.observe(len(ops)); H_COMMIT_PASSES.observe(len(batch))
+        for _, fut in batch:
+            if not fut.done(): fut.set_result(None)
+
+    async def _commit_pass(self, ops: List[Op]):
+        """Commit one pass on its own. Transient failures (locked DB, I/O, full disk, journal fsync) are
+        retried with backoff while later passes wait behind it; once the DB rejects the pass outright its
+        records are committed one by one, skipping (and reporting) the rejected ones - the books and the
+        journal keep the state. Transient failures during that walk resume at the record that failed."""
+        delay = 0.1; single = False; i = 0
+        while True:
+            try:
+                if not single:
+                    await self.db.run(self.commit, ops)
+                    break
+                while i < len(ops):
+                    try:
+                        await self.db.run(self.commit, [ops[i]])
+                    except _REJECTED as e:
+                        C_COMMIT_FAULTS.labels("skipped").inc()
+                        print(f"ERROR DB rejected a record, skipped ({e}): {ops[i][0].split()[0]} {ops[i][1]!r}")
+                    i += 1
+                break
+            except _REJECTED:
+                single = True
+            except Exception as e:
+                C_COMMIT_FAULTS.labels("retried").inc(); G_COMMIT_HALTED.set(1)
+                print(f"ERROR commit of a pass failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay); delay = min(delay * 2, GROUP_COMMIT_RETRY_MAX_S)
+        G_COMMIT_HALTED.set(0)
+
+_WRITER: List[GroupCommitWriter] = []
+
+
+def get_writer(db: DBExecutor, commit: Callable[[Any, List[Op]], None]) -> GroupCommitWriter:
+    """Return the process-wide writer, starting its task on first use (inside the event loop)"""
+    if not _WRITER:
+        _WRITER.append(GroupCommitWriter(db, commit))
+    return _WRITER[0]
@@ -0,0 +1,63 @@
+"""
+History Cache - Encoded responses of the price history endpoints per (endpoint, market, range, aggregation)
+An entry is valid while the market's data version is unchanged (bumped by every new price) and it is
+younger than max_age_s (the sampler keeps appending readings and the windows slide with the clock).
+The ETag is a hash of the body; bodies carry no clock-dependent fields (bucket-aligned cutoffs, no
+current_time), so a rebuild over unchanged data - here or in another process - yields the same tag.
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, NamedTuple, Optional
+
+from prometheus_client import Counter
+
+C_HCACHE = Counter("pho_history_cache_requests_total", "History endpoint requests by cache outcome", ["result"])
+
+
+class Entry(NamedTuple):
+    version: int
+    stored: float   # monotonic time the body was built
+    body: bytes
+    etag: str
+
+
+class HistoryCache:
+    """LRU of encoded history responses, stamped with a per-market data version"""
+
+    def __init__(self, max_age_s: float = 30.0, max_entries: int = 256):
+        self.max_age_s = max_age_s
+        self.max_entries = max_entries
+        self.versions: Dict[str, int] = {}
+        self.entries: "OrderedDict[Hashable, Entry]" = OrderedDict()
+
+    def version(self, market: str) -> int:
+        return self.versions.get(market, 0)
+
+    def bump(self, market: str):
+        """New price data for `market`: its cached responses are outdated"""
+        self.versions[market] = self.versions.get(market, 0) + 1
+
+    def get(self, key: Hashable, market: str) -> Optional[Entry]:
+        e = self.entries.get(key)
+        if e is None: return None
+        if e.version != self.version(market) or time.monotonic() - e.stored > self.max_age_s:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return e
+
+    def put(self, key: Hashable, version: int, body: bytes) -> Entry:
+        """Store a body built from data as of `version` (taken before the query, so a bump during
+        the query leaves the entry already outdated)"""
+        e = Entry(version, time.monotonic(), body, '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"')
+        self.entries[key] = e; self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+        return e
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (weak, list or '*')"""
+    if not if_none_match: return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
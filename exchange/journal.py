@@ -0,0 +1,189 @@
+"""
+Event Journal - Append-only, length-prefixed binary journal plus periodic book snapshots
+Recovery loads the latest snapshot and replays only the journal segments written after it.
+
+Record framing: <u32 payload length><u32 crc32(payload)><u64 lsn><payload (compact JSON)>
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Gauge, Histogram
+
+_HDR = struct.Struct("<IIQ")
+
+H_FSYNC = Histogram("pho_journal_fsync_seconds", "Journal fsync duration",
+                    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+G_JOURNAL_LSN = Gauge("pho_journal_lsn", "Last journal sequence number written")
+G_RECOVERY = Gauge("pho_recovery_seconds", "Snapshot load + journal replay time at startup")
+
+
+class Journal:
+    """Journal segments `journal-<first lsn>.bin` and snapshots `snapshot-<lsn>.bin` in one directory"""
+
+    def __init__(self, directory: str):
+        self.dir = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lsn = 0
+        self._f = None
+        self._seg_first = 1
+        self._durable = 0
+        # append() runs on the event loop, sync() on the DB executor thread: records are
+        # handed over through _pending under _lock; only sync() touches the segment file
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[int, bytes]] = []
+        self._rotate_at: Optional[int] = None
+
+    # ---- file naming ----
+    def _files(self, prefix: str) -> List[Tuple[int, str]]:
+        out = []
+        for name in os.listdir(self.dir):
+            if name.startswith(prefix + "-") and name.endswith(".bin"):
+                try: out.append((int(name[len(prefix) + 1:-4]), os.path.join(self.dir, name)))
+                except ValueError: pass
+        return sorted(out)
+
+    def _segment_path(self, first_lsn: int) -> str:
+        return os.path.join(self.dir, f"journal-{first_lsn:016d}.bin")
+
+    def _open(self, first_lsn: int):
+        path = self._segment_path(first_lsn)
+        self._f = open(path, "ab")
+        self._seg_first = first_lsn
+        self._durable = os.path.getsize(path)  # bytes of the open segment known to be on disk
+
+    # ---- recovery ----
+    def recover(self, load_snapshot: Callable[[Dict[str, Any]], None], apply: Callable[[Dict[str, Any]], None]) -> bool:
+        """Load the newest snapshot, replay the journal tail and open a segment for appending
+
+        Returns False if neither a snapshot nor journal records exist (fresh state dir).
+        """
+        t0 = time.perf_counter()
+        found = False
+        snaps = self._files("snapshot")
+        if snaps:
+            lsn, path = snaps[-1]
+            with open(path, "rb") as f:
+                load_snapshot(json.loads(zlib.decompress(f.read())))
+            self.lsn = lsn; found = True
+        for first, path in self._files("journal"):
+            for rec_lsn, event in self._read_segment(path):
+                if rec_lsn <= self.lsn:
+                    continue
+                apply(event); self.lsn = rec_lsn; found = True
+        self._open(self.lsn + 1)
+        G_JOURNAL_LSN.set(self.lsn)
+        G_RECOVERY.set(time.perf_counter() - t0)
+        return found
+
+    def records_after(self, lsn: int):
+        """(lsn, event) of the records after `lsn` still on disk, in order (DB reconciliation)"""
+        for first, path in self._files("journal"):
+            for rec_lsn, event in self._read_segment(path):
+                if rec_lsn > lsn: yield rec_lsn, event
+
+    @staticmethod
+    def _read_segment(path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        off = 0; n = len(data)
+        while off + _HDR.size <= n:
+            length, crc, lsn = _HDR.unpack_from(data, off)
+            start = off + _HDR.size; end = start + length
+            if end > n or zlib.crc32(data[start:end]) != crc:
+                # Torn write at the tail: drop everything from here on
+                with open(path, "r+b") as f: f.truncate(off)
+                return
+            yield lsn, json.loads(data[start:end])
+            off = end
+
+    # ---- append path ----
+    def append(self, event: Dict[str, Any]) -> int:
+        """Buffer one event; it is durable after the next sync()"""
+        payload = json.dumps(event, separators=(",", ":")).encode()
+        with self._lock:
+            self.lsn += 1
+            self._pending.append((self.lsn, _HDR.pack(len(payload), zlib.crc32(payload), self.lsn) + payload))
+            return self.lsn
+
+    def sync(self):
+        """Write and fsync everything appended so far (one fsync per batch); call from one thread at a time
+
+        Records stay pending until their fsync succeeded, so a failed sync can simply be retried:
+        the retry cuts the segment back to its last durable size (no torn record) and rewrites them.
+        """
+        with self._lock:
+            recs = list(self._pending)
+            rot = self._rotate_at
+        if not recs and rot is None:
+            return
+        t0 = time.perf_counter()
+        if rot is not None:
+            # Records up to the snapshot lsn stay in the old segment, the rest start a new one
+            if rot + 1 != self._seg_first:
+                self._write(b"".join(r for lsn, r in recs if lsn <= rot))
+                self._done(rot, rot)
+                self._f.close(); self._f = None
+                self._open(rot + 1)
+            else:
+                self._done(rot, rot)
+            recs = [(lsn, r) for lsn, r in recs if lsn > rot]
+        if recs:
+            self._write(b"".join(r for _, r in recs))
+            self._done(recs[-1][0], None)
+            G_JOURNAL_LSN.set(recs[-1][0])
+        H_FSYNC.observe(time.perf_counter() - t0)
+
+    def _write(self, data: bytes):
+        """Append `data` to the open segment and fsync it"""
+        if self._f is None:
+            # A previous attempt failed: drop whatever part of it reached the file, then rewrite
+            path = self._segment_path(self._seg_first)
+            if os.path.exists(path) and os.path.getsize(path) > self._durable: os.truncate(path, self._durable)
+            self._f = open(path, "ab")
+        try:
+            self._f.write(data); self._f.flush(); os.fsync(self._f.fileno())
+        except BaseException:
+            try: self._f.close()
+            except Exception: pass
+            self._f = None
+            raise
+        self._durable += len(data)
+
+    def _done(self, upto: int, rot: Optional[int]):
+        """Records up to `upto` (and the rotation at `rot`) are on disk"""
+        with self._lock:
+            self._pending = [p for p in self._pending if p[0] > upto]
+            if rot is not None and self._rotate_at == rot: self._rotate_at = None
+
+    # ---- snapshots ----
+    def rotate(self) -> int:
+        """Mark a segment boundary at the current lsn (applied by the next sync());
+        returns the lsn the next snapshot must cover"""
+        with self._lock:
+            self._rotate_at = self.lsn
+            return self.lsn
+
+    def write_snapshot(self, lsn: int, state: Dict[str, Any]):
+        """Atomically write a snapshot taken at `lsn`, then drop older snapshots and segments"""
+        path = os.path.join(self.dir, f"snapshot-{lsn:016d}.bin")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(zlib.compress(json.dumps(state, separators=(",", ":")).encode(), 1))
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for s_lsn, p in self._files("snapshot"):
+            if s_lsn < lsn: os.remove(p)
+        for first, p in self._files("journal"):
+            # The open segment stays until a sync() has applied the rotation (replay skips lsn <= snapshot)
+            if first <= lsn and first != self._seg_first: os.remove(p)
+
+    def close(self):
+        if self._f is None and not self._pending: return
+        self.sync()
+        if self._f is not None:
+            self._f.close(); self._f = None
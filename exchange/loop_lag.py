@@ -0,0 +1,49 @@
+"""
+Event Loop Lag - Probe task measuring how late the asyncio loop resumes a sleeping task
+Any blocking call on the loop (sync SQLite/Redis I/O, fsync, long CPU work) shows up as lag.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from prometheus_client import Gauge, Histogram
+
+H_LOOP_LAG = Histogram("pho_event_loop_lag_seconds", "Delay of event loop wake-ups beyond the scheduled time",
+                       buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+G_LOOP_LAG_MAX = Gauge("pho_event_loop_lag_max_seconds", "Largest event loop lag in the recent window")
+
+
+class LoopLagProbe:
+    """Sleeps `interval` seconds in a loop and records how much later than requested it wakes up"""
+
+    def __init__(self, interval: float = 0.01, window: int = 1000):
+        self.interval = interval
+        self.samples: deque = deque(maxlen=window)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> "LoopLagProbe":
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel(); self.task = None
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - t0 - self.interval)
+            self.samples.append(lag)
+            H_LOOP_LAG.observe(lag)
+            G_LOOP_LAG_MAX.set(max(self.samples))
+
+    def stats(self) -> Dict[str, float]:
+        """p50/p99/max lag in milliseconds over the current window"""
+        if not self.samples:
+            return {"p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0, "samples": 0}
+        s = sorted(self.samples); n = len(s)
+        pick = lambda q: round(s[min(n - 1, int(q * n))] * 1000.0, 3)
+        return {"p50_ms": pick(0.50), "p99_ms": pick(0.99), "max_ms": round(s[-1] * 1000.0, 3), "samples": n}
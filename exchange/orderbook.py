@@ -0,0 +1,199 @@
+"""
+Order Book - In-memory price-time-priority book for the Phoenyra matching engine
+The book is the source of truth for matching; SQLite only records the results.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+EPS = 1e-9
+
+
+class BookOrder:
+    """A resting (or incoming) order as seen by the matching engine"""
+    __slots__ = ("id", "user_key", "side", "price", "qty", "filled", "ts")
+
+    def __init__(self, id: str, user_key: str, side: str, price: float, qty: float, filled: float = 0.0, ts: str = ""):
+        self.id = id
+        self.user_key = user_key
+        self.side = side
+        self.price = float(price)
+        self.qty = float(qty)
+        self.filled = float(filled)
+        self.ts = ts
+
+    @property
+    def remaining(self) -> float:
+        return self.qty - self.filled
+
+
+class BookSide:
+    """One side of the book: sorted price levels with a FIFO queue per level
+
+    Level keys are kept in an ascending list where the best level is always
+    the last element (bids keyed by +price, asks by -price), so the best
+    price is found in O(1) and levels are located by bisection.
+    """
+
+    def __init__(self, side: str):
+        self.side = side
+        self._sign = 1.0 if side == "BUY" else -1.0
+        self._keys: List[float] = []
+        self.levels: Dict[float, "OrderedDict[str, BookOrder]"] = {}
+        self.sizes: Dict[float, float] = {}
+        self.changed = set()  # level prices touched since the last delta
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, o: BookOrder):
+        level = self.levels.get(o.price)
+        if level is None:
+            level = self.levels[o.price] = OrderedDict()
+            self.sizes[o.price] = 0.0
+            k = self._sign * o.price
+            self._keys.insert(bisect_left(self._keys, k), k)
+        level[o.id] = o
+        self.sizes[o.price] += o.remaining
+        self.changed.add(o.price)
+
+    def remove(self, o: BookOrder):
+        level = self.levels.get(o.price)
+        if level is None or level.pop(o.id, None) is None:
+            return
+        self.sizes[o.price] -= o.remaining
+        self.changed.add(o.price)
+        if not level:
+            self._drop_level(o.price)
+
+    def _drop_level(self, price: float):
+        del self.levels[price]; del self.sizes[price]
+        k = self._sign * price
+        i = bisect_left(self._keys, k)
+        if i < len(self._keys) and self._keys[i] == k:
+            self._keys.pop(i)
+
+    def iter_orders(self):
+        """Orders in priority order: best level first, FIFO within a level"""
+        for k in reversed(self._keys):
+            yield from self.levels[self._sign * k].values()
+
+    def delta(self) -> List[Tuple[float, float]]:
+        """(price, new size) for every touched level, best first; size 0.0 means the level is gone"""
+        out = sorted(((p, self.sizes.get(p, 0.0)) for p in self.changed), key=lambda x: -self._sign * x[0])
+        self.changed.clear()
+        return out
+
+    def best(self) -> Optional[float]:
+        return self._sign * self._keys[-1] if self._keys else None
+
+    def depth(self, n: int = 10) -> List[Tuple[float, float]]:
+        out = []
+        for k in reversed(self._keys[-n:] if n else self._keys):
+            p = self._sign * k
+            out.append((p, self.sizes[p]))
+        return out
+
+
+class OrderBook:
+    """Price-time-priority book for a single (market, delivery product)"""
+
+    def __init__(self, market: str, product: str = "", index: Optional[Dict[str, "OrderBook"]] = None,
+                 listener: Optional[Callable[["OrderBook", BookOrder, float], None]] = None):
+        self.market = market
+        self.product = product
+        self.bids = BookSide("BUY")
+        self.asks = BookSide("SELL")
+        self.orders: Dict[str, BookOrder] = {}
+        self.seq = 0  # bumped once per published delta
+        # Shared order-id -> book index across all books (for cancel/amend lookups)
+        self.index = index if index is not None else {}
+        # listener(book, order, d_remaining) sees every change of resting quantity (exposure ledger)
+        self.listener = listener or (lambda book, o, dq: None)
+
+    def side_of(self, side: str) -> BookSide:
+        return self.bids if side == "BUY" else self.asks
+
+    def add(self, o: BookOrder):
+        self.orders[o.id] = o
+        self.index[o.id] = self
+        self.side_of(o.side).add(o)
+        self.listener(self, o, o.remaining)
+
+    def remove(self, order_id: str) -> Optional[BookOrder]:
+        o = self.orders.pop(order_id, None)
+        if o is not None:
+            self.index.pop(order_id, None)
+            self.side_of(o.side).remove(o)
+            self.listener(self, o, -o.remaining)
+        return o
+
+    def amend_qty(self, order_id: str, qty: float) -> Optional[BookOrder]:
+        """Reduce an order's total quantity in place; it keeps its queue position"""
+        o = self.orders.get(order_id)
+        if o is None:
+            return None
+        side = self.side_of(o.side)
+        side.sizes[o.price] += qty - o.qty; side.changed.add(o.price)
+        self.listener(self, o, qty - o.qty)
+        o.qty = float(qty)
+        if o.remaining <= EPS:
+            self.remove(order_id)
+        return o
+
+    def reduce(self, order_id: str, qty: float) -> Optional[BookOrder]:
+        """Apply an executed quantity to a resting order, keeping its queue position"""
+        o = self.orders.get(order_id)
+        if o is None:
+            return None
+        o.filled += qty
+        side = self.side_of(o.side)
+        side.sizes[o.price] -= qty; side.changed.add(o.price)
+        self.listener(self, o, -qty)
+        if o.remaining <= EPS:
+            self.remove(order_id)
+        return o
+
+    def iter_orders(self):
+        yield from self.bids.iter_orders()
+        yield from self.asks.iter_orders()
+
+    def match(self, taker: BookOrder) -> List[Tuple[BookOrder, float]]:
+        """Match `taker` against the opposite side, best price first, FIFO within a level
+
+        Returns a list of (maker, executed_qty). Fully filled makers are
+        removed from the book; the taker itself is never added here.
+        """
+        opp = self.asks if taker.side == "BUY" else self.bids
+        fills = []
+        while taker.remaining > EPS:
+            px = opp.best()
+            if px is None or (px > taker.price if taker.side == "BUY" else px < taker.price):
+                break
+            level = opp.levels[px]
+            maker = next(iter(level.values()))
+            qty = min(taker.remaining, maker.remaining)
+            maker.filled += qty; taker.filled += qty
+            opp.sizes[px] -= qty; opp.changed.add(px)
+            self.listener(self, maker, -qty)
+            if maker.remaining <= EPS:
+                del level[maker.id]; del self.orders[maker.id]; self.index.pop(maker.id, None)
+                if not level:
+                    opp._drop_level(px)
+            fills.append((maker, qty))
+        return fills
+
+    def depth(self, n: int = 10) -> Dict[str, List[Tuple[float, float]]]:
+        return {"bids": self.bids.depth(n), "asks": self.asks.depth(n)}
+
+    def take_delta(self) -> Optional[Dict]:
+        """Changed levels since the last call with the next sequence number, or None if unchanged"""
+        bids, asks = self.bids.delta(), self.asks.delta()
+        if not bids and not asks:
+            return None
+        self.seq += 1
+        return {"seq": self.seq, "bids": bids, "asks": asks}
+
+    def snapshot(self) -> Dict:
+        """Full depth at the current sequence number; deltas with seq > this apply on top"""
+        return {"product": self.product, "seq": self.seq, **self.depth(0)}
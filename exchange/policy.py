@@ -0,0 +1,114 @@
+"""
+Policy Store - policy.yaml compiled into an immutable Policy, reloaded by a watcher task
+The hot path only reads `store.current`; a reload builds a new Policy and swaps the reference.
+Changes are picked up via inotify (watchfiles) where available, by polling the mtime otherwise.
+"""
+import asyncio
+import os
+import threading
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Optional, Tuple
+
+import yaml
+from prometheus_client import Counter, Gauge
+
+try:
+    from watchfiles import awatch
+except ImportError:  # optional: fall back to polling
+    awatch = None
+
+DEFAULT_RPS = 120.0  # orders per minute when a market has no per_market_rps entry
+DEFAULT_VWAP_WINDOW = 96  # price ticks in the rolling VWAP when a market has no vwap_window entry
+PRICE_SAMPLE_S = float(os.getenv("PRICE_SAMPLE_S", "10"))  # history sampler cadence without price_sample_s entry (dashboards plot 10 s points)
+POLICY_POLL_S = float(os.getenv("POLICY_POLL_S", "2"))
+POLICY_WATCH = os.getenv("POLICY_WATCH", "auto")  # auto | poll
+
+G_POLICY_REVISION = Gauge("pho_policy_revision", "Number of policy swaps since start")
+C_POLICY_ERRORS = Counter("pho_policy_reload_errors_total", "policy.yaml reloads rejected (previous policy kept)")
+
+
+class Policy(NamedTuple):
+    """Compiled policy.yaml; never mutated, replaced as a whole on reload"""
+    revision: int                                   # local swap counter
+    version: Any                                    # `version` field of the file
+    mtime: float
+    limits: Mapping[str, Tuple[float, float]]       # market -> (rate per minute, burst)
+    vwap_windows: Mapping[str, int]                 # market -> rolling VWAP window (ticks)
+    sample_s: Mapping[str, float]                   # market -> price history sampler cadence (s)
+
+    def limit(self, market: str) -> Tuple[float, float]:
+        return self.limits.get(market) or (DEFAULT_RPS, DEFAULT_RPS)
+
+    def vwap_window(self, market: str) -> int:
+        return self.vwap_windows.get(market, DEFAULT_VWAP_WINDOW)
+
+    def sample_interval(self, market: str) -> float:
+        return self.sample_s.get(market, PRICE_SAMPLE_S)
+
+
+def compile_policy(data: dict, revision: int, mtime: float) -> Policy:
+    rps = data.get("per_market_rps") or {}
+    burst = data.get("per_market_burst") or {}
+    limits = {m: (float(v), float(burst.get(m, v))) for m, v in rps.items()}
+    for m, b in burst.items():
+        limits.setdefault(m, (DEFAULT_RPS, float(b)))
+    windows = {m: max(1, int(v)) for m, v in (data.get("vwap_window") or {}).items()}
+    sample_s = {m: max(0.1, float(v)) for m, v in (data.get("price_sample_s") or {}).items()}
+    return Policy(revision, data.get("version"), mtime, MappingProxyType(limits), MappingProxyType(windows),
+                  MappingProxyType(sample_s))
+
+
+class PolicyStore:
+    """Holds the current Policy; reload() is shared by the watcher and /admin/policy/reload"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.current = compile_policy({}, 0, 0.0)
+        self.task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._failed_mtime: Optional[float] = None  # broken file already reported
+
+    def reload(self, force: bool = False) -> Policy:
+        """Re-read the file if its mtime changed (or `force`); a broken file keeps the old policy"""
+        with self._lock:
+            cur = self.current; mtime = None
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if not force and mtime in (cur.mtime, self._failed_mtime):
+                    return cur
+                with open(self.path) as f:
+                    data = yaml.safe_load(f) or {}
+                new = compile_policy(data, cur.revision + 1, mtime)
+            except FileNotFoundError:
+                if not force and cur.mtime == 0.0:
+                    return cur
+                new = compile_policy({}, cur.revision + 1, 0.0)
+            except Exception as e:
+                self._failed_mtime = mtime
+                C_POLICY_ERRORS.inc()
+                print(f"ERROR loading policy {self.path}: {e} (keeping revision {cur.revision})")
+                return cur
+            self.current = new
+            G_POLICY_REVISION.set(new.revision)
+            return new
+
+    def start(self) -> "PolicyStore":
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel(); self.task = None
+
+    async def _run(self):
+        if awatch is not None and POLICY_WATCH != "poll":
+            try:
+                # Watch the directory: editors and config mounts replace the file rather than write it
+                async for _ in awatch(os.path.dirname(os.path.abspath(self.path))):
+                    await asyncio.to_thread(self.reload)
+            except Exception as e:
+                print(f"WARNING: policy watch unavailable ({e}), polling every {POLICY_POLL_S}s")
+        while True:
+            await asyncio.sleep(POLICY_POLL_S)
+            await asyncio.to_thread(self.reload)
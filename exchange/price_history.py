@@ -0,0 +1,252 @@
+"""
+Price History - market_price_history split into one SQLite table per UTC day
+Ticks are inserted into the partition of their timestamp; retention drops whole partitions on a
+schedule instead of DELETE-ing rows, and range queries read the UNION ALL of overlapping days.
+
+Each tick also updates OHLC/sum/count rollups of mark, EMA and VWAP at 1 minute, 15 minute,
+1 hour and 1 day resolution, so aggregated history reads one row per bucket instead of raw ticks.
+"""
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from prometheus_client import Gauge
+
+PREFIX = "market_price_history_"
+LEGACY = "market_price_history"  # unpartitioned table of older versions, migrated once
+COLS = "timestamp, mark, ema, vwap, ts"
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Rollup levels: (table, bucket width ms), finest first
+LEVELS = (("price_rollup_1m", 60 * 1000), ("price_rollup_15m", 15 * 60 * 1000),
+          ("price_rollup_1h", 60 * 60 * 1000), ("price_rollup_1d", DAY_MS))
+FIELDS = ("mark", "ema", "vwap")
+_AGG_COLS = ["n", "t_first", "t_last"] + [f"{f}_{a}" for f in FIELDS for a in "ohlcs"]
+# Merges an aggregate (a single tick is n=1) into its bucket; SET expressions see the old row,
+# so open/close follow t_first/t_last even if a sample arrives out of order
+_UPSERT = ("INSERT INTO {t}(market, bucket, " + ", ".join(_AGG_COLS) + ") VALUES(?, ?, " + ", ".join("?" * len(_AGG_COLS)) + ") "
+           "ON CONFLICT(market, bucket) DO UPDATE SET n = n + excluded.n, "
+           "t_first = min(t_first, excluded.t_first), t_last = max(t_last, excluded.t_last), "
+           + ", ".join(f"{f}_o = CASE WHEN excluded.t_first < t_first THEN excluded.{f}_o ELSE {f}_o END, "
+                       f"{f}_h = max({f}_h, excluded.{f}_h), {f}_l = min({f}_l, excluded.{f}_l), "
+                       f"{f}_c = CASE WHEN excluded.t_last >= t_last THEN excluded.{f}_c ELSE {f}_c END, "
+                       f"{f}_s = {f}_s + excluded.{f}_s" for f in FIELDS))
+
+G_PARTITIONS = Gauge("pho_price_history_partitions", "Daily market_price_history partitions on disk")
+
+
+def day_of(ts_ms: int) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).strftime("%Y%m%d")
+
+
+def partition_of(ts_ms: int) -> str:
+    return PREFIX + day_of(ts_ms)
+
+
+def day_start_ms(day: str) -> int:
+    return int(datetime.strptime(day, "%Y%m%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def list_partitions(con: sqlite3.Connection) -> List[str]:
+    """Partition tables in ascending day order"""
+    rows = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ? ESCAPE '\\'",
+                       (PREFIX.replace("_", "\\_") + "%",)).fetchall()
+    return sorted(r[0] for r in rows if r[0][len(PREFIX):].isdigit())
+
+
+def source(con: sqlite3.Connection, market: str, start_ts: int, end_ts: Optional[int] = None) -> Tuple[str, list]:
+    """FROM-clause subquery `(...)` with columns COLS over the partitions overlapping
+    [start_ts, end_ts) for one market, plus its parameters"""
+    lo = day_of(start_ts); hi = day_of(end_ts) if end_ts is not None else None
+    arms = []; params: list = []
+    for name in list_partitions(con):
+        day = name[len(PREFIX):]
+        if day < lo or (hi is not None and day > hi): continue
+        where = "market = ? AND timestamp >= ?"; params += [market, start_ts]
+        if end_ts is not None: where += " AND timestamp < ?"; params.append(end_ts)
+        arms.append(f"SELECT {COLS} FROM {name} WHERE {where}")
+    if not arms:
+        return "(SELECT NULL AS timestamp, NULL AS mark, NULL AS ema, NULL AS vwap, NULL AS ts WHERE 0)", []
+    return "(" + " UNION ALL ".join(arms) + ")", params
+
+
+def page_after(con: sqlite3.Connection, market: str, ts: int, rid: int, limit: int, end_ts: Optional[int] = None) -> list:
+    """Up to `limit` rows (id, COLS) of one market strictly after the (timestamp, id) watermark
+    (and before `end_ts`), in (timestamp, id) order. A timestamp determines its partition, so the
+    pair is a total order."""
+    out: list = []
+    lo = day_of(max(ts, 0)); hi = day_of(end_ts) if end_ts is not None else None
+    for name in list_partitions(con):
+        day = name[len(PREFIX):]
+        if day < lo: continue
+        if hi is not None and day > hi: break
+        sql = f"SELECT id, {COLS} FROM {name} WHERE market = ? AND timestamp >= ? AND (timestamp > ? OR id > ?)"
+        params: list = [market, ts, ts, rid]
+        if end_ts is not None: sql += " AND timestamp < ?"; params.append(end_ts)
+        out += con.execute(sql + " ORDER BY timestamp, id LIMIT ?", params + [limit - len(out)]).fetchall()
+        if len(out) >= limit: break
+    return out
+
+
+def pick_level(interval_ms: int) -> Tuple[str, int]:
+    """Coarsest rollup whose buckets tile `interval_ms` exactly"""
+    best = LEVELS[0]
+    for name, width in LEVELS:
+        if width <= interval_ms and interval_ms % width == 0: best = (name, width)
+    return best
+
+
+def fit_interval(span_ms: int, interval_ms: int, max_buckets: int) -> int:
+    """`interval_ms`, or the next coarser rollup width, so that `span_ms` needs at most `max_buckets`
+    buckets (the daily level if none does)"""
+    if span_ms // interval_ms <= max_buckets: return interval_ms
+    for _, width in LEVELS:
+        if width > interval_ms and span_ms // width <= max_buckets: return width
+    return max(interval_ms, LEVELS[-1][1])
+
+
+def rollup(con: sqlite3.Connection, market: str, start_ts: int, interval_ms: int, end_ts: Optional[int] = None,
+           limit: Optional[int] = None) -> List[dict]:
+    """Buckets of `interval_ms` from the coarsest fitting rollup, ascending; each with n, t_first,
+    t_last and <field>_open/high/low/close/avg. Buckets overlapping start_ts are included whole."""
+    table, width = pick_level(interval_ms)
+    sql = f"SELECT bucket, {', '.join(_AGG_COLS)} FROM {table} WHERE market = ? AND bucket >= ?"
+    params: list = [market, (start_ts // width) * width]
+    if end_ts is not None: sql += " AND bucket < ?"; params.append(end_ts)
+    sql += " ORDER BY bucket"
+    out: List[dict] = []; cur = None
+    for row in con.execute(sql, params):
+        b = (row[0] // interval_ms) * interval_ms
+        if cur is None or cur["bucket"] != b:
+            if limit is not None and len(out) >= limit: break
+            cur = {"bucket": b, "n": 0, "t_first": row[2], "t_last": row[3]}
+            for f in FIELDS: cur.update({f"{f}_open": row[f"{f}_o"], f"{f}_high": row[f"{f}_h"], f"{f}_low": row[f"{f}_l"], f"{f}_sum": 0.0})
+            out.append(cur)
+        cur["n"] += row["n"]; cur["t_last"] = row["t_last"]
+        for f in FIELDS:
+            cur[f"{f}_high"] = max(cur[f"{f}_high"], row[f"{f}_h"]); cur[f"{f}_low"] = min(cur[f"{f}_low"], row[f"{f}_l"])
+            cur[f"{f}_close"] = row[f"{f}_c"]; cur[f"{f}_sum"] += row[f"{f}_s"]
+    for cur in out:
+        for f in FIELDS: cur[f"{f}_avg"] = cur.pop(f"{f}_sum") / cur["n"]
+    return out
+
+
+def rollup_totals(con: sqlite3.Connection, market: str) -> Tuple[int, Optional[int], Optional[int]]:
+    """(ticks, first timestamp, last timestamp) of a market from the daily rollup"""
+    row = con.execute("SELECT COALESCE(SUM(n), 0), MIN(t_first), MAX(t_last) FROM price_rollup_1d WHERE market = ?", (market,)).fetchone()
+    return row[0], row[1], row[2]
+
+
+def _agg_values(n: int, t_first: int, t_last: int, vals: dict) -> list:
+    return [n, t_first, t_last] + [vals[f][k] for f in FIELDS for k in range(5)]
+
+
+class PriceHistory:
+    """Writer side (DB executor thread): partition creation, inserts and retention"""
+
+    def __init__(self, retention_days: int = 90):
+        self.retention_days = retention_days
+        self._known: set = set()  # partitions created by / known to this writer
+        self._last: dict = {}      # market -> timestamp of its newest row written by this writer
+
+    def table_for(self, con: sqlite3.Connection, ts_ms: int) -> str:
+        """Partition holding `ts_ms`, created on first use"""
+        name = partition_of(ts_ms)
+        self._ensure(con, name)
+        return name
+
+    @staticmethod
+    def create_rollups(con: sqlite3.Connection):
+        for table, _ in LEVELS:
+            con.execute(f"CREATE TABLE IF NOT EXISTS {table}(market TEXT NOT NULL, bucket INTEGER NOT NULL, n INTEGER, "
+                        f"t_first INTEGER, t_last INTEGER, {', '.join(f'{f}_{a} REAL' for f in FIELDS for a in 'ohlcs')}, "
+                        f"PRIMARY KEY(market, bucket)) WITHOUT ROWID")
+
+    def _ensure(self, con: sqlite3.Connection, name: str):
+        if name in self._known: return
+        con.execute(f"CREATE TABLE IF NOT EXISTS {name}(id INTEGER PRIMARY KEY AUTOINCREMENT, market TEXT, "
+                    f"mark REAL, ema REAL, vwap REAL, timestamp INTEGER, ts TEXT)")
+        con.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_market_ts ON {name}(market, timestamp)")
+        self._known.add(name)
+
+    def next_ts(self, con: sqlite3.Connection, market: str) -> int:
+        """Timestamp for a new row, taken on the writer thread and strictly increasing per market:
+        rows commit in (timestamp, id) order, which the sync watermark (page_after) relies on"""
+        last = self._last.get(market)
+        if last is None:
+            parts = list_partitions(con)
+            row = con.execute(f"SELECT MAX(timestamp) FROM {parts[-1]} WHERE market = ?", (market,)).fetchone() if parts else None
+            last = (row[0] if row else None) or 0
+        ts_ms = max(int(time.time() * 1000), last + 1)
+        self._last[market] = ts_ms
+        return ts_ms
+
+    def insert(self, con: sqlite3.Connection, market: str, mark: float, ema: float, vwap: float) -> int:
+        """Write one price point (writer thread only; see next_ts); returns its timestamp"""
+        ts_ms = self.next_ts(con, market)
+        name = self.table_for(con, ts_ms)
+        con.execute(f"INSERT INTO {name}(market, mark, ema, vwap, timestamp, ts) VALUES(?,?,?,?,?,?)",
+                    (market, mark, ema, vwap, ts_ms, datetime.utcnow().isoformat()))
+        vals = {"mark": (mark, mark, mark, mark, mark), "ema": (ema, ema, ema, ema, ema), "vwap": (vwap, vwap, vwap, vwap, vwap)}
+        agg = _agg_values(1, ts_ms, ts_ms, vals)
+        for table, width in LEVELS:
+            con.execute(_UPSERT.format(t=table), [market, (ts_ms // width) * width] + agg)
+        return ts_ms
+
+    def backfill_rollups(self, con: sqlite3.Connection) -> int:
+        """Build the rollups from the raw partitions if they are empty (first start with rollups)"""
+        self.create_rollups(con)
+        parts = list_partitions(con)
+        if not parts or con.execute("SELECT 1 FROM price_rollup_1d LIMIT 1").fetchone(): return 0
+        ticks = 0
+        for name in parts:
+            buckets: dict = {}  # (table, market, bucket) -> [n, t_first, t_last, {field: [o, h, l, c, s]}]
+            for market, ts_ms, *prices in con.execute(f"SELECT market, timestamp, {', '.join(FIELDS)} FROM {name} "
+                                                      f"WHERE timestamp IS NOT NULL AND mark IS NOT NULL AND ema IS NOT NULL AND vwap IS NOT NULL ORDER BY timestamp"):
+                ticks += 1
+                for table, width in LEVELS:
+                    k = (table, market, (ts_ms // width) * width)
+                    b = buckets.get(k)
+                    if b is None:
+                        buckets[k] = [1, ts_ms, ts_ms, {f: [p, p, p, p, p] for f, p in zip(FIELDS, prices)}]
+                        continue
+                    b[0] += 1; b[2] = ts_ms
+                    for f, p in zip(FIELDS, prices):
+                        v = b[3][f]; v[1] = max(v[1], p); v[2] = min(v[2], p); v[3] = p; v[4] += p
+            for (table, market, bucket), (n, t0, t1, vals) in buckets.items():
+                con.execute(_UPSERT.format(t=table), [market, bucket] + _agg_values(n, t0, t1, vals))
+            con.commit()
+        return ticks
+
+    def drop_expired(self, con: sqlite3.Connection, now_ms: Optional[int] = None) -> List[str]:
+        """Drop partitions whose whole day lies before the retention cutoff; returns their names"""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        cutoff = now_ms - self.retention_days * DAY_MS
+        dropped = []
+        parts = list_partitions(con)
+        for name in parts:
+            if day_start_ms(name[len(PREFIX):]) + DAY_MS > cutoff: break
+            con.execute(f"DROP TABLE IF EXISTS {name}")
+            self._known.discard(name); dropped.append(name)
+        for table, width in LEVELS:  # rollups are small: row-wise retention, once per run
+            con.execute(f"DELETE FROM {table} WHERE bucket < ?", ((cutoff // DAY_MS) * DAY_MS,))
+        con.commit()
+        G_PARTITIONS.set(len(parts) - len(dropped))
+        return dropped
+
+    def migrate_legacy(self, con: sqlite3.Connection) -> int:
+        """Move rows of the unpartitioned table into daily partitions and drop it (one-time)"""
+        if not con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (LEGACY,)).fetchone():
+            return 0
+        days = [r[0] for r in con.execute(f"SELECT DISTINCT timestamp / {DAY_MS} FROM {LEGACY} WHERE timestamp IS NOT NULL")]
+        moved = 0
+        for d in days:
+            start = int(d) * DAY_MS
+            name = self.table_for(con, start)
+            moved += con.execute(f"INSERT INTO {name}(market, mark, ema, vwap, timestamp, ts) SELECT market, mark, ema, vwap, timestamp, ts "
+                                 f"FROM {LEGACY} WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+                                 (start, start + DAY_MS)).rowcount
+        con.execute(f"DROP TABLE {LEGACY}")
+        con.commit()
+        return moved
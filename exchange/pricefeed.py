@@ -0,0 +1,209 @@
+"""
+Price Aggregator - Per-market mark / EMA / rolling VWAP maintained in process, O(1) per tick
+VWAP runs over a ring buffer of the last `window` ticks with running price*volume and volume
+sums; the state is checkpointed to Redis and restored from checkpoint + stream tail on first use.
+
+Price Sampler - In-memory price snapshot per market for readers, refreshed and persisted to the
+price history by one background task per market at a fixed cadence.
+"""
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+EMA_ALPHA = 0.2
+CHECKPOINT_EVERY = 50  # ticks between checkpoints (restore replays the stream after it)
+
+
+class RollingVWAP:
+    """Volume-weighted average of the last `window` (price, volume) ticks"""
+
+    def __init__(self, window: int):
+        self.window = max(1, int(window))
+        self.ticks: deque = deque()
+        self.pv = 0.0
+        self.vol = 0.0
+        self._since_resum = 0
+
+    def resize(self, window: int):
+        self.window = max(1, int(window))
+        while len(self.ticks) > self.window: self._evict()
+
+    def push(self, price: float, volume: float):
+        self.ticks.append((price, volume))
+        self.pv += price * volume; self.vol += volume
+        if len(self.ticks) > self.window: self._evict()
+        # Re-add the sums once per window so floating point drift cannot accumulate (amortized O(1))
+        self._since_resum += 1
+        if self._since_resum >= self.window:
+            self.pv = sum(p * v for p, v in self.ticks); self.vol = sum(v for _, v in self.ticks)
+            self._since_resum = 0
+
+    def _evict(self):
+        p, v = self.ticks.popleft()
+        self.pv -= p * v; self.vol -= v
+
+    def value(self, default: float) -> float:
+        return self.pv / self.vol if self.vol > 0 else default
+
+
+class MarketPrices:
+    """Mark, EMA and rolling VWAP of one market"""
+
+    def __init__(self, market: str, window: int):
+        self.market = market
+        self.vwap = RollingVWAP(window)
+        self.mark: Optional[float] = None
+        self.ema: Optional[float] = None
+        self.last_id: Optional[str] = None  # stream id of the newest tick included
+        self.unsaved = 0
+
+    def push(self, price: float, volume: float, stream_id: Optional[str] = None) -> Tuple[float, float, float]:
+        self.ema = price if self.ema is None else EMA_ALPHA * price + (1 - EMA_ALPHA) * self.ema
+        self.mark = price
+        self.vwap.push(price, volume)
+        if stream_id is not None: self.last_id = stream_id
+        self.unsaved += 1
+        return price, self.ema, self.vwap.value(price)
+
+    def checkpoint(self) -> Dict[str, str]:
+        self.unsaved = 0
+        return {"id": self.last_id or "", "ticks": json.dumps(list(self.vwap.ticks))}
+
+
+def _decode(v) -> str:
+    return v.decode() if isinstance(v, bytes) else v
+
+
+class PriceAggregator:
+    """MarketPrices per market; `restore` must run once per market before its first push"""
+
+    def __init__(self, redis):
+        self.r = redis
+        self.markets: Dict[str, MarketPrices] = {}
+
+    @staticmethod
+    def stream_key(market: str) -> str: return f"price:stream:{market}"
+
+    @staticmethod
+    def checkpoint_key(market: str) -> str: return f"price:agg:{market}"
+
+    async def get(self, market: str, window: int) -> MarketPrices:
+        mp = self.markets.get(market)
+        if mp is None:
+            mp = await self.restore(market, window)
+            mp = self.markets.setdefault(market, mp)  # another push may have restored it meanwhile
+        elif mp.vwap.window != window:
+            mp.vwap.resize(window)
+        return mp
+
+    async def restore(self, market: str, window: int) -> MarketPrices:
+        """VWAP ring from the checkpoint (if any) plus the stream entries written after it;
+        mark and EMA from their keys, which every push writes together with the stream entry"""
+        mp = MarketPrices(market, window)
+        async with self.r.pipeline(transaction=False) as p:
+            p.hgetall(self.checkpoint_key(market))
+            p.mget(f"price:mark:{market}", f"price:ema:{market}")
+            raw_cp, (mark, ema) = await p.execute()
+        cp = {_decode(k): _decode(v) for k, v in raw_cp.items()}
+        if cp.get("id"):
+            for pr, v in json.loads(cp["ticks"]): mp.vwap.push(pr, v)
+            mp.last_id = cp["id"]
+            entries = await self.r.xrevrange(self.stream_key(market), min="(" + cp["id"], count=window)
+        else:
+            entries = await self.r.xrevrange(self.stream_key(market), count=window)
+        for eid, fields in reversed(entries):
+            mp.push(float(_decode(fields[b"p"])), float(_decode(fields.get(b"v", b"1"))), _decode(eid))
+        if mark is not None: mp.mark = float(mark)
+        if ema is not None: mp.ema = float(ema)
+        mp.unsaved = 0
+        return mp
+
+    def write(self, p, mp: MarketPrices, price: float, volume: float, ts_ms: int) -> Tuple[float, float, float]:
+        """Apply a tick and queue the stream append, price keys and (periodic) checkpoint on pipeline `p`"""
+        # Explicit ids (not '*') so the checkpoint can name its last tick without waiting for the reply
+        sid = self._next_id(mp, ts_ms)
+        mark, ema, vwap = mp.push(price, volume, sid)
+        m = mp.market
+        p.xadd(self.stream_key(m), {"p": price, "v": volume, "ts": ts_ms}, id=sid, maxlen=10000, approximate=True)
+        p.mset({f"price:mark:{m}": mark, f"price:ema:{m}": ema, f"price:vwap:{m}": vwap})
+        if mp.unsaved >= CHECKPOINT_EVERY:
+            p.hset(self.checkpoint_key(m), mapping=mp.checkpoint())
+        return mark, ema, vwap
+
+    @staticmethod
+    def _next_id(mp: MarketPrices, ts_ms: int) -> str:
+        """Strictly increasing stream id <ms>-<seq> even if the clock stalls or steps back"""
+        if mp.last_id:
+            ms, _, seq = mp.last_id.partition("-")
+            ms = int(ms); seq = int(seq or 0)
+            if ts_ms <= ms: return f"{ms}-{seq + 1}"
+        return f"{ts_ms}-0"
+
+    def checkpoints(self) -> List[Tuple[str, Dict[str, str]]]:
+        """Pending checkpoints of all markets (shutdown)"""
+        return [(self.checkpoint_key(m), mp.checkpoint()) for m, mp in self.markets.items() if mp.unsaved]
+
+
+Snapshot = Tuple[float, float, float, int]  # mark, ema, vwap, ts_ms
+
+
+class PriceSampler:
+    """Snapshot per market for GET /market/prices; one sampler task per tracked market refreshes
+    it from Redis (other processes may receive the pushes) and hands it to `persist`"""
+
+    def __init__(self, redis, persist: Callable[[str, float, float, float], Awaitable[None]],
+                 cadence: Callable[[str], float], max_markets: int = 64, retry_s: float = 60.0,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.r = redis
+        self.persist = persist
+        self.cadence = cadence
+        self.on_change = on_change  # called when a refresh finds prices pushed through another process
+        self.max_markets = max_markets
+        self.retry_s = retry_s
+        self.snapshot: Dict[str, Snapshot] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._misses: Dict[str, float] = {}  # market without prices -> monotonic time of the check
+
+    def update(self, market: str, mark: float, ema: float, vwap: float, ts_ms: int):
+        """Local push: snapshot is current at once, and the market gets a sampler"""
+        self.snapshot[market] = (mark, ema, vwap, ts_ms)
+        self.track(market)
+
+    def track(self, market: str):
+        """Start sampling `market` unless it is sampled, the limit is reached or it had no prices recently"""
+        if market in self.tasks or len(self.tasks) >= self.max_markets: return
+        missed = self._misses.get(market)
+        if missed is not None and time.monotonic() - missed < self.retry_s: return
+        self.tasks[market] = asyncio.get_running_loop().create_task(self._run(market))
+
+    def stop(self):
+        for t in self.tasks.values(): t.cancel()
+        self.tasks.clear()
+
+    async def refresh(self, market: str) -> Optional[Snapshot]:
+        mark, ema, vwap = await self.r.mget(f"price:mark:{market}", f"price:ema:{market}", f"price:vwap:{market}")
+        if mark is None: return None
+        mark = float(mark)
+        snap = (mark, float(ema or mark), float(vwap or mark), int(time.time() * 1000))
+        prev = self.snapshot.get(market)
+        self.snapshot[market] = snap
+        if self.on_change and (prev is None or prev[:3] != snap[:3]): self.on_change(market)
+        return snap
+
+    async def _run(self, market: str):
+        try:
+            while True:
+                try:
+                    snap = await self.refresh(market)
+                    if snap is None and market not in self.snapshot:
+                        self._misses[market] = time.monotonic()
+                        return  # unknown market: re-checked on a later request after retry_s
+                    if snap is not None and 0 < snap[0] < 1000:  # only valid prices go to the history
+                        await self.persist(market, snap[0], snap[1], snap[2])
+                except Exception as e:
+                    print(f"ERROR sampling prices for {market}: {e}")
+                await asyncio.sleep(self.cadence(market))
+        finally:
+            if self.tasks.get(market) is asyncio.current_task(): del self.tasks[market]
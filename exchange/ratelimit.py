@@ -0,0 +1,74 @@
+"""
+Rate Limiter - Token bucket per (api_key, market), refilled and charged by one Redis Lua call
+The bucket refills continuously at `rate` tokens per minute (scaled by SoC/temperature) up to
+`burst`; a local fast-reject cache skips Redis while a bucket is known to be empty.
+"""
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import Counter
+
+C_RL_REDIS = Counter("pho_ratelimit_redis_calls_total", "Token bucket round trips to Redis", [])
+C_RL_FAST_REJECT = Counter("pho_ratelimit_fast_rejects_total", "Requests rejected from the local empty-bucket cache", [])
+
+# KEYS[1] bucket hash {tk: tokens, ts: last refill (ms)}
+# ARGV rate (tokens/minute), burst (capacity), scale, n (tokens requested)
+# -> {granted, remaining tokens * 1000, ms until the next whole token (0 if one is left)}
+# Time comes from the Redis server so all exchange workers share one clock.
+_LUA = """
+local scale = tonumber(ARGV[3])
+local rate = tonumber(ARGV[1]) * scale / 60000.0
+local cap = math.max(1, tonumber(ARGV[2]) * scale)
+local n = tonumber(ARGV[4])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local b = redis.call('HMGET', KEYS[1], 'tk', 'ts')
+local tokens = tonumber(b[1])
+local ts = tonumber(b[2])
+if tokens == nil or ts == nil then
+  tokens = cap
+else
+  tokens = math.min(cap, tokens + math.max(0, now - ts) * rate)
+end
+local granted = math.max(0, math.min(n, math.floor(tokens)))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tk', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(cap / math.max(rate, 1e-9)) + 1000)
+local wait = 0
+if tokens < 1 then wait = math.ceil((1 - tokens) / math.max(rate, 1e-9)) end
+return {granted, math.floor(tokens * 1000), wait}
+"""
+
+
+class TokenBucketLimiter:
+    """Atomic token bucket in Redis with a local cache of the last known bucket state"""
+
+    def __init__(self, redis, prefix: str = "tb"):
+        self.prefix = prefix
+        self._script = redis.register_script(_LUA)
+        self._empty: Dict[Tuple[str, str], float] = {}  # key -> monotonic time of the next whole token
+        self._last: Dict[Tuple[str, str], Tuple[float, float, float, float]] = {}  # key -> (tokens, at, rate/s, cap)
+
+    async def take(self, api_key: str, market: str, rate: float, burst: float, scale: float, n: int = 1) -> Tuple[int, int]:
+        """Charge up to `n` tokens; returns (granted, remaining whole tokens)"""
+        key = (api_key, market); now = time.monotonic()
+        until = self._empty.get(key)
+        if until is not None:
+            if now < until:
+                C_RL_FAST_REJECT.inc()
+                return 0, 0
+            del self._empty[key]
+        C_RL_REDIS.inc()
+        granted, milli, wait_ms = await self._script(keys=[f"{self.prefix}:{api_key}:{market}"], args=[rate, burst, scale, n])
+        tokens = int(milli) / 1000.0
+        self._last[key] = (tokens, now, rate * scale / 60.0, max(1.0, burst * scale))
+        if int(wait_ms) > 0:
+            self._empty[key] = now + int(wait_ms) / 1000.0
+        return int(granted), int(tokens)
+
+    def remaining(self, api_key: str, market: str, default: int = 0) -> int:
+        """Local estimate of the whole tokens left, refilled since the last Redis call (no I/O)"""
+        last = self._last.get((api_key, market))
+        if last is None: return default
+        tokens, at, rate, cap = last
+        return int(min(cap, tokens + (time.monotonic() - at) * rate))
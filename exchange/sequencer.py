@@ -0,0 +1,95 @@
+"""
+Market Sequencer - Single-writer command queue per market for the Phoenyra matching engine
+One consumer task per market owns that market's books; commands get deterministic
+sequence numbers at enqueue time and are handed to the handler in batches.
+Durability is reported asynchronously: the next batch is processed while the previous
+one is still being committed; callers' futures resolve once their batch is durable.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Gauge, Histogram
+
+G_SEQ_DEPTH = Gauge("pho_seq_queue_depth", "Pending commands in the market sequencer", ["market"])
+G_SEQ_LAST = Gauge("pho_seq_last", "Last sequence number processed", ["market"])
+G_SEQ_DURABLE = Gauge("pho_seq_durable", "Last sequence number reported durable", ["market"])
+H_SEQ_LATENCY = Histogram("pho_seq_latency_seconds", "Enqueue-to-result latency of sequenced commands", ["market"],
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+H_SEQ_BATCH = Histogram("pho_seq_batch_size", "Commands processed per sequencer pass", ["market"],
+                        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+# handler(market, [(seq, cmd), ...]) -> ([result_or_exception, ...] (same order), durable)
+# `durable` is an awaitable completing once the batch is committed (None: already durable)
+BatchHandler = Callable[[str, List[Tuple[int, Dict[str, Any]]]], Awaitable[Tuple[List[Any], Optional[Awaitable]]]]
+
+
+class MarketSequencer:
+    """asyncio queue drained by exactly one consumer task per market"""
+
+    def __init__(self, market: str, handler: BatchHandler, max_batch: int = 256, max_inflight: int = 64):
+        self.market = market
+        self.handler = handler
+        self.max_batch = max_batch
+        self.seq = 0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._inflight = asyncio.Semaphore(max_inflight)  # batches processed but not yet durable
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def submit(self, cmd: Dict[str, Any]) -> asyncio.Future:
+        """Enqueue a command; the returned future resolves with the handler result"""
+        self.seq += 1
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((self.seq, time.perf_counter(), cmd, fut))
+        G_SEQ_DEPTH.labels(self.market).set(self.queue.qsize())
+        return fut
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Drain whatever queued up while the previous pass ran
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            G_SEQ_DEPTH.labels(self.market).set(self.queue.qsize())
+            H_SEQ_BATCH.labels(self.market).observe(len(batch))
+            try:
+                results, durable = await self.handler(self.market, [(seq, cmd) for seq, _, cmd, _ in batch])
+            except Exception as e:
+                results, durable = [e] * len(batch), None
+            G_SEQ_LAST.labels(self.market).set(batch[-1][0])
+            if durable is None:
+                self._resolve(batch, results)
+            else:
+                # Bounded pipelining: stop taking new batches if too many commits are outstanding
+                await self._inflight.acquire()
+                asyncio.get_running_loop().create_task(self._resolve_when_durable(batch, results, durable))
+
+    async def _resolve_when_durable(self, batch: list, results: List[Any], durable: Awaitable):
+        try:
+            await durable
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            self._inflight.release()
+        self._resolve(batch, results)
+
+    def _resolve(self, batch: list, results: List[Any]):
+        done = time.perf_counter()
+        for (seq, t0, _, fut), res in zip(batch, results):
+            H_SEQ_LATENCY.labels(self.market).observe(done - t0)
+            if fut.done():
+                continue
+            if isinstance(res, Exception): fut.set_exception(res)
+            else: fut.set_result(res)
+        G_SEQ_DURABLE.labels(self.market).set(batch[-1][0])
+
+
+SEQUENCERS: Dict[str, MarketSequencer] = {}
+
+
+def get_sequencer(market: str, handler: BatchHandler) -> MarketSequencer:
+    """Return the market's sequencer, starting its consumer task on first use"""
+    s = SEQUENCERS.get(market)
+    if s is None:
+        s = SEQUENCERS[market] = MarketSequencer(market, handler)
+    return s
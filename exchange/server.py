@@ -1,51 +1,88 @@
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Header, Body
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, validator
-from typing import Optional, Literal, Dict, List, Tuple
-from datetime import datetime
-import os, json, sqlite3, redis, time, yaml, uuid, asyncio, hmac, hashlib, base64
+from typing import Any, Optional, Literal, Dict, List, Tuple
+from datetime import datetime, timezone
+import os, json, sqlite3, time, uuid, asyncio, hmac, hashlib, base64, itertools, struct
+import redis.asyncio as aioredis
 
 from prometheus_client import Gauge, Counter, generate_latest, CONTENT_TYPE_LATEST
+from orderbook import OrderBook, BookOrder, EPS
+from sequencer import get_sequencer
+from journal import Journal
+from ws_hub import Subscriptions, Client, clients_info
+from dbexec import DBExecutor, connect
+from group_commit import get_writer
+from loop_lag import LoopLagProbe
+from ratelimit import TokenBucketLimiter
+from policy import PolicyStore
+from pricefeed import PriceAggregator, PriceSampler
+from price_history import PriceHistory, source as history_source, list_partitions, rollup, rollup_totals, page_after, fit_interval
+from bess_state import BessState, BessStateCache, limits as bess_limits
+import export as history_export
+from history_cache import HistoryCache, etag_matches, C_HCACHE
 
 app = FastAPI(title="Phoenyra Exchange v1.3 (ULTRA OMEGA+)")
 
-DB_PATH = os.getenv("SQLITE_PATH","/app/exchange.db")
+STATE_DIR = os.getenv("EXCHANGE_STATE_DIR","/app/state")
+# The DB lives next to the journal/snapshots: recovered books must only hold orders the DB knows
+DB_PATH = os.getenv("SQLITE_PATH",os.path.join(STATE_DIR,"exchange.db"))
 REDIS_HOST = os.getenv("REDIS_HOST","redis"); REDIS_PORT=int(os.getenv("REDIS_PORT","6379")); REDIS_DB=int(os.getenv("REDIS_DB","0"))
 POLICY_PATH = os.getenv("POLICY_PATH","/app/policy/policy.yaml")
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL","60"))
 
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+r = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+SQLITE_READERS = int(os.getenv("SQLITE_READERS","4"))
+PRICE_RETENTION_DAYS = int(os.getenv("PRICE_RETENTION_DAYS","90"))
+PRICE_RETENTION_CHECK_S = int(os.getenv("PRICE_RETENTION_CHECK_S","3600"))
 
 def db():
-    conn = sqlite3.connect(DB_PATH, timeout=10.0); conn.row_factory = sqlite3.Row; return conn
+    """Tuned (WAL) write connection for one-off startup work"""
+    return connect(DB_PATH)
+
+# Async handlers never touch sqlite3 directly. Writes run on one dedicated thread with its own
+# connection (one statement batch + commit per call); history/order/trade reads run on a pool of
+# read-only connections, so readers never block the write path (WAL).
+DB = DBExecutor(DB_PATH, "db")
+DB_READ = DBExecutor(DB_PATH, "db_read", workers=SQLITE_READERS, readonly=True)
+LOOP_LAG = LoopLagProbe()
 
 def init_db():
+    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
     con=db(); c=con.cursor()
     c.executescript("""    CREATE TABLE IF NOT EXISTS users(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, api_key TEXT UNIQUE, role TEXT, status TEXT);
     CREATE TABLE IF NOT EXISTS orders(id TEXT PRIMARY KEY, user_key TEXT, market TEXT, side TEXT, type TEXT, tif TEXT, p_limit REAL, qty REAL, d_start TEXT, d_end TEXT, status TEXT, filled REAL, ts TEXT);
     CREATE TABLE IF NOT EXISTS trades(id TEXT PRIMARY KEY, order_id TEXT, user_key TEXT, executed REAL, price REAL, ts TEXT, market TEXT, side TEXT);
     CREATE TABLE IF NOT EXISTS orderbook_history(id INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT, market TEXT, bids TEXT, asks TEXT);
-    CREATE TABLE IF NOT EXISTS market_price_history(id INTEGER PRIMARY KEY AUTOINCREMENT, market TEXT, mark REAL, ema REAL, vwap REAL, timestamp INTEGER, ts TEXT);
-    CREATE INDEX IF NOT EXISTS idx_market_price_history_market_ts ON market_price_history(market, timestamp);
+    CREATE TABLE IF NOT EXISTS journal_state(id INTEGER PRIMARY KEY CHECK (id = 1), lsn INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_orders_market_product ON orders(market, d_start, d_end, status);
     """    )
-    con.commit(); con.close()
+    # Migration: book snapshots are stored per delivery product
+    try: c.execute("ALTER TABLE orderbook_history ADD COLUMN product TEXT")
+    except sqlite3.OperationalError: pass
+    # Range scans of the history exports (export.py)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_market_ts ON trades(market, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orderbook_history_market_ts ON orderbook_history(market, ts)")
+    con.commit()
+    # Migration: price history is stored in daily partitions (price_history.py)
+    moved = PRICE_HISTORY.migrate_legacy(con)
+    if moved: print(f"Migrated {moved} market_price_history rows into daily partitions")
+    ticks = PRICE_HISTORY.backfill_rollups(con)
+    if ticks: print(f"Built price rollups from {ticks} history rows")
+    con.close()
+PRICE_HISTORY = PriceHistory(PRICE_RETENTION_DAYS)
 init_db()
 
 # ---- Policy hot-reload + webhook ----
-_POLICY = {"mtime":0, "data":{}}
-def load_policy(force=False):
-    try:
-        st = os.stat(POLICY_PATH).st_mtime
-        if force or st != _POLICY["mtime"]:
-            with open(POLICY_PATH) as f:
-                _POLICY["data"] = yaml.safe_load(f) or {}
-            _POLICY["mtime"] = st
-    except FileNotFoundError:
-        _POLICY["data"] = {}
-    return _POLICY["data"]
+# Hot path reads POLICY.current (compiled, immutable); the watcher task swaps in new revisions
+POLICY = PolicyStore(POLICY_PATH)
+POLICY.reload()
 
 @app.post("/admin/policy/reload")
 def policy_reload():
-    pol = load_policy(force=True)
-    return {"status":"OK","version":pol.get("version")}
+    pol = POLICY.reload(force=True)
+    return {"status":"OK","version":pol.version,"revision":pol.revision}
 
 # ---- HMAC keys (rotation + discovery) ----
 def _decode_secret(s):
@@ -105,43 +142,222 @@ async def get_user(x_api_key: Optional[str] = Header(default=None)) -> User:
     return User()
 
 # ---- Book & exposure ----
-BOOK: Dict[str, Dict[str, List[Tuple[float,float]]]] = {}
-def ensure_market(m): 
-    if m not in BOOK: BOOK[m]={"bids":[], "asks":[]}
-def persist_book(market:str):
+# In-memory books are the source of truth for matching; SQLite only records results.
+# Books are sharded per (market, delivery product): BOOKS[market][product] -> OrderBook
+BOOKS: Dict[str, Dict[str, OrderBook]] = {}
+ORDER_INDEX: Dict[str, OrderBook] = {}  # resting order id -> its book (cancel/amend lookups)
+INJECT_KEY = "__inject__"  # owner of liquidity seeded via /admin/book_inject (no orders row)
+def _iso_utc(v: str) -> str:
+    d = datetime.fromisoformat(v.replace("Z","+00:00"))
+    return (d.astimezone(timezone.utc) if d.tzinfo else d).isoformat()
+def product_key(d_start: Optional[str], d_end: Optional[str]) -> str:
+    """Delivery product id as ISO 8601 interval 'start/end' (UTC-normalized); '' if unspecified"""
+    if not d_start or not d_end: return ""
+    return _iso_utc(d_start) + "/" + _iso_utc(d_end)
+def parse_product(p: Optional[str]) -> Optional[str]:
+    """Normalize a client-supplied 'start/end' product id; None/'' stays None"""
+    if not p: return None
+    start, _, end = p.partition("/")
+    return product_key(start, end) if end else p
+class ExposureLedger:
+    """Net energy / notional of resting orders keyed by (user, market, product), updated in O(1)
+    from book changes (accept, fill, cancel, amend); rebuilt implicitly when books are recovered."""
+    def __init__(self):
+        self.by_key: Dict[Tuple[str,str,str], List[float]] = {}
+        self.by_user: Dict[str, Dict[str, List[float]]] = {}
+        self.by_market: Dict[str, List[float]] = {}
+    @staticmethod
+    def _bump(d: dict, k, de: float, dn: float):
+        v = d.get(k)
+        if v is None: v = d[k] = [0.0, 0.0]
+        v[0] += de; v[1] += dn
+        if abs(v[0]) <= EPS and abs(v[1]) <= EPS: del d[k]
+        return v
+    def on_change(self, book: OrderBook, o: BookOrder, dq: float):
+        if o.user_key == INJECT_KEY or dq == 0.0: return
+        de = dq if o.side == "BUY" else -dq; dn = dq * abs(o.price)
+        self._bump(self.by_key, (o.user_key, book.market, book.product), de, dn)
+        self._bump(self.by_user.setdefault(o.user_key, {}), book.market, de, dn)
+        tot = self._bump(self.by_market, book.market, de, dn)
+        G_EXPO_E.labels(book.market).set(tot[0]); G_EXPO_N.labels(book.market).set(tot[1])
+    def of_user(self, api_key: str) -> dict:
+        m = self.by_user.get(api_key, {})
+        return {"energy": {k: v[0] for k, v in m.items()}, "notional": {k: v[1] for k, v in m.items()}}
+    def products_of(self, api_key: str) -> List[dict]:
+        return [{"market": m, "product": p, "energy": v[0], "notional": v[1]}
+                for (u, m, p), v in self.by_key.items() if u == api_key]
+EXPOSURE = ExposureLedger()
+def get_book(m: str, product: str = "") -> OrderBook:
+    books = BOOKS.get(m)
+    if books is None: books = BOOKS[m] = {}
+    book = books.get(product)
+    if book is None: book = books[product] = OrderBook(m, product, ORDER_INDEX, EXPOSURE.on_change)
+    return book
+def load_books():
+    """Rebuild resting orders from the orders table (fallback when no journal/snapshot exists)"""
     con=db(); c=con.cursor()
-    c.execute("INSERT INTO orderbook_history(ts,market,bids,asks) VALUES(?,?,?,?)",
-              (datetime.utcnow().isoformat(), market, json.dumps(BOOK[market]["bids"][:50]), json.dumps(BOOK[market]["asks"][:50])))
+    c.execute("SELECT id, user_key, market, side, p_limit, qty, filled, d_start, d_end, ts FROM orders WHERE status='ACCEPTED' AND filled < qty ORDER BY ts ASC")
+    for row in c.fetchall():
+        get_book(row["market"], product_key(row["d_start"], row["d_end"])).add(
+            BookOrder(row["id"], row["user_key"], row["side"], row["p_limit"] or 0.0, row["qty"], row["filled"] or 0.0, row["ts"]))
+    con.close()
+def persist_book(ops, market:str, product:str=""):
+    depth = get_book(market, product).depth(50)
+    ops.append(("INSERT INTO orderbook_history(ts,market,product,bids,asks) VALUES(?,?,?,?,?)",
+                (datetime.utcnow().isoformat(), market, product, json.dumps(depth["bids"]), json.dumps(depth["asks"]))))
+
+# ---- Journal + snapshots (book recovery) ----
+# Every accepted order, fill and injection is journaled by the sequencer before the DB commit.
+JOURNAL = Journal(STATE_DIR)
+def book_state() -> dict:
+    return {"books":[{"m":b.market,"p":b.product,"o":[[o.id,o.user_key,o.side,o.price,o.qty,o.filled,o.ts] for o in b.iter_orders()]}
+                     for books in BOOKS.values() for b in books.values() if b.orders]}
+def load_book_state(state: dict):
+    for b in state.get("books", []):
+        book = get_book(b["m"], b["p"])
+        for row in b["o"]: book.add(BookOrder(*row))
+def apply_inject(book: OrderBook, orders: List[list]):
+    """Injected levels replace previously injected liquidity; real resting orders stay untouched"""
+    for o in [o for o in book.orders.values() if o.user_key == INJECT_KEY]: book.remove(o.id)
+    for oid, side, p, q, ts in orders:
+        book.add(BookOrder(oid, INJECT_KEY, side, p, q, 0.0, ts))
+def replay_event(ev: dict):
+    book = get_book(ev["m"], ev["p"]); t = ev["t"]
+    if t == "new":
+        book.add(BookOrder(ev["id"], ev["u"], ev["s"], ev["px"], ev["q"], 0.0, ev["ts"]))
+    elif t == "fill":
+        book.reduce(ev["maker"], ev["q"]); book.reduce(ev["taker"], ev["q"])
+    elif t == "inject":
+        apply_inject(book, ev["o"])
+    elif t == "cancel":
+        book.remove(ev["id"])
+    elif t == "amend":
+        if ev["keep"]: book.amend_qty(ev["id"], ev["q"])
+        else:
+            o = reprice(book, ev["id"], ev["px"], ev["q"], ev["ts"])
+            if o is not None: book.add(o)  # fills after the amend are replayed from their own events
+def reprice(book: OrderBook, order_id: str, price: float, qty: float, ts: str) -> Optional[BookOrder]:
+    """Take an amended order out of the book with new price/qty/ts; re-adding it puts it
+    at the back of its level (it loses time priority)"""
+    o = book.remove(order_id)
+    if o is None: return None
+    o.price = float(price); o.qty = float(qty); o.ts = ts
+    return o
+def take_snapshot() -> Tuple[int, dict]:
+    """Mark a journal segment boundary and capture book state at that lsn (call on the event loop)"""
+    lsn = JOURNAL.rotate()
+    return lsn, book_state()
+_FILLED = "UPDATE orders SET filled = ?, status = CASE WHEN ? >= qty - ? THEN 'FILLED' ELSE 'ACCEPTED' END WHERE id = ?"
+def journal_db_ops(ev: dict) -> List[Tuple[str, tuple]]:
+    """Idempotent SQL re-creating the DB effect of one journal event (absolute values, upserts)"""
+    t = ev["t"]
+    if t == "new":
+        return [("""INSERT INTO orders(id,user_key,market,side,type,tif,p_limit,qty,d_start,d_end,status,filled,ts)
+                    VALUES(?,?,?,?,?,?,?,?,?,?,'ACCEPTED',0,?) ON CONFLICT(id) DO NOTHING""",
+                 (ev["id"],ev["u"],ev["m"],ev["s"],ev.get("ot","LIMIT"),ev.get("tif","GFD"),ev["px"],ev["q"],ev.get("ds"),ev.get("de"),ev["ts"]))]
+    if t == "fill":
+        if "tid" not in ev: return []  # journaled before fills carried their trade row
+        return [("""INSERT INTO trades(id, order_id, user_key, executed, price, ts, market, side)
+                    VALUES(?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO NOTHING""",
+                 (ev["tid"],ev["taker"],ev["mu"],ev["q"],ev["px"],ev["ts"],ev["m"],ev["s"])),
+                (_FILLED, (ev["mf"], ev["mf"], EPS, ev["maker"])), (_FILLED, (ev["tf"], ev["tf"], EPS, ev["taker"]))]
+    if t == "cancel":
+        return [("UPDATE orders SET status = 'CANCELLED' WHERE id = ?", (ev["id"],))]
+    if t == "amend":
+        return [("UPDATE orders SET p_limit = ?, qty = ?, ts = ?, status = CASE WHEN filled >= ? - ? THEN 'FILLED' ELSE 'ACCEPTED' END WHERE id = ?",
+                 (ev["px"], ev["q"], ev["ts"], ev["q"], EPS, ev["id"]))]
+    return []  # inject: book liquidity only (its orderbook_history row is not re-created)
+def reconcile_db():
+    """The journal is fsynced before the DB commit (and synchronous=NORMAL can lose a commit on power
+    failure): re-apply records past the DB's journal_state.lsn, so the DB knows every recovered order"""
+    con = db()
+    row = con.execute("SELECT lsn FROM journal_state WHERE id = 1").fetchone()
+    if row is not None and row[0] < JOURNAL.lsn:
+        n = 0; first = None
+        for lsn, ev in JOURNAL.records_after(row[0]):
+            if first is None: first = lsn
+            for sql, args in journal_db_ops(ev): con.execute(sql, args)
+            n += 1
+        if first is not None and first != row[0] + 1:
+            print(f"WARNING: journal records {row[0] + 1}..{first - 1} are no longer on disk; the DB may miss their effects")
+        if n: print(f"Re-applied {n} journal records the database had not committed")
+    # Without a row (first start with LSN tracking) the DB is taken as in step with the journal;
+    # a reset journal (fresh state dir) restarts the numbering
+    con.execute("INSERT INTO journal_state(id, lsn) VALUES(1, ?) ON CONFLICT(id) DO UPDATE SET lsn = excluded.lsn", (JOURNAL.lsn,))
     con.commit(); con.close()
+if not JOURNAL.recover(load_book_state, replay_event):
+    # Fresh state dir: seed from the orders table once, then snapshot so restarts skip the scan
+    load_books(); JOURNAL.write_snapshot(*take_snapshot())
+reconcile_db()
+
+async def snapshot_loop():
+    last = JOURNAL.lsn
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        if JOURNAL.lsn == last: continue
+        lsn, state = take_snapshot()
+        try:
+            # The segment boundary is applied by the journal's next sync (on the DB thread)
+            await DB.run(lambda con: JOURNAL.sync())
+            # Older segments are deleted with the snapshot: the DB must durably hold everything up to lsn
+            # (passes journaled before take_snapshot() are already queued at the writer)
+            await get_writer(DB, commit_pass).flush()
+            busy = await DB.run(lambda con: con.execute("PRAGMA wal_checkpoint(FULL)").fetchone()[0])
+            if busy: continue  # readers in the way: retry next interval, keep the segments
+            await asyncio.to_thread(JOURNAL.write_snapshot, lsn, state)
+            last = lsn
+        except Exception as e:
+            print(f"ERROR writing book snapshot: {e}")
+
+async def retention_loop():
+    """Drop expired price history partitions (whole days) instead of DELETE-ing rows per tick"""
+    while True:
+        try:
+            dropped = await DB.run(PRICE_HISTORY.drop_expired)
+            if dropped: print(f"Dropped expired price history partitions: {', '.join(dropped)}")
+        except Exception as e:
+            print(f"ERROR applying price history retention: {e}")
+        await asyncio.sleep(PRICE_RETENTION_CHECK_S)
+
+@app.on_event("startup")
+async def start_snapshots():
+    asyncio.create_task(snapshot_loop()); asyncio.create_task(retention_loop())
+    LOOP_LAG.start(); POLICY.start(); BESS.start()
+
+@app.on_event("shutdown")
+async def close_journal():
+    LOOP_LAG.stop(); POLICY.stop(); BESS.stop(); SAMPLER.stop()
+    for key, cp in PRICES.checkpoints(): await r.hset(key, mapping=cp)
+    await get_writer(DB, commit_pass).flush()  # commit what the sequencers already handed over
+    DB_READ.close(); DB.close(); JOURNAL.close()
 
 def exposure_of(api_key: str):
-    con=db(); c=con.cursor()
-    c.execute("SELECT market, side, qty, filled, p_limit FROM orders WHERE status!='CANCELLED'")
-    netE={}; netN={}
-    for row in c.fetchall():
-        m=row["market"]; rem=row["qty"]-row["filled"]; s=1 if row["side"]=="BUY" else -1
-        netE[m]=netE.get(m,0.0)+s*rem; netN[m]=netN.get(m,0.0)+abs(rem*(row["p_limit"] or 0.0))
-    con.close()
-    for m,v in netE.items(): G_EXPO_E.labels(m).set(float(v))
-    for m,v in netN.items(): G_EXPO_N.labels(m).set(float(v))
-    return {"energy":netE,"notional":netN}
+    """Resting exposure of one user per market, read from the ledger (no DB access)"""
+    return EXPOSURE.of_user(api_key)
+
+@app.get("/exposure")
+def get_exposure(user: User = Depends(get_user)):
+    """Resting exposure of the calling user per market and per delivery product"""
+    return {**EXPOSURE.of_user(user.api_key), "products": EXPOSURE.products_of(user.api_key)}
 
 # ---- Telemetry with SoC-driven scaling ----
+# Each process holds the latest versioned snapshot, refreshed from the telemetry:bess channel
+def _bess_gauges(st: BessState):
+    G_SOC.set(st.soc); G_PWR.set(st.power); G_TEMP.set(st.temp)
+BESS = BessStateCache(r, _bess_gauges)
+
 class TelemetryIn(BaseModel):
     soc_percent: float
     active_power_mw: float
     temperature_c: float
 @app.post("/telemetry/bess")
-def telemetry(b: TelemetryIn):
-    r.set("telemetry:soc", b.soc_percent)
-    r.set("telemetry:power", b.active_power_mw)
-    r.set("telemetry:temp", b.temperature_c)
-    G_SOC.set(b.soc_percent); G_PWR.set(b.active_power_mw); G_TEMP.set(b.temperature_c)
-    return {"status":"OK"}
+async def telemetry(b: TelemetryIn):
+    st = await BESS.publish(b.soc_percent, b.active_power_mw, b.temperature_c)
+    return {"status":"OK","version":st.version}
 
 # ---- REST API für externe BESS-Systeme ----
 @app.post("/api/bess/telemetry")
-def external_telemetry(api_key: str = Header(None)):
+async def external_telemetry(data: Optional[dict] = Body(default=None), api_key: str = Header(None)):
     """REST API für externe BESS-Systeme"""
     # API-Key Validierung
     expected_key = os.getenv("BESS_API_KEY", "bess_telemetry_key")
@@ -149,7 +365,6 @@ def external_telemetry(api_key: str = Header(None)):
         return {"error": "Unauthorized", "status": 401}
     
     try:
-        data = request.get_json()
         if not data:
             return {"error": "No JSON data provided", "status": 400}
         
@@ -161,12 +376,7 @@ def external_telemetry(api_key: str = Header(None)):
         )
         
         # An interne Telemetrie-Funktion weiterleiten
-        r.set("telemetry:soc", telemetry_data.soc_percent)
-        r.set("telemetry:power", telemetry_data.active_power_mw)
-        r.set("telemetry:temp", telemetry_data.temperature_c)
-        G_SOC.set(telemetry_data.soc_percent)
-        G_PWR.set(telemetry_data.active_power_mw)
-        G_TEMP.set(telemetry_data.temperature_c)
+        await BESS.publish(telemetry_data.soc_percent, telemetry_data.active_power_mw, telemetry_data.temperature_c)
         
         return {
             "status": "OK",
@@ -183,155 +393,201 @@ def external_telemetry(api_key: str = Header(None)):
         return {"error": f"Telemetrie-Fehler: {str(e)}", "status": 500}
 
 @app.get("/api/bess/status")
-def get_bess_status():
+async def get_bess_status():
     """Aktuelle BESS-Status abrufen"""
     try:
-        soc = float(r.get("telemetry:soc") or 0.0)
-        power = float(r.get("telemetry:power") or 0.0)
-        temp = float(r.get("telemetry:temp") or 0.0)
+        st = BESS.current
+        soc, power, temp = (st.soc, st.power, st.temp) if st else (0.0, 0.0, 0.0)
         
         return {
             "soc_percent": soc,
             "active_power_mw": power,
             "temperature_c": temp,
             "timestamp": datetime.now().isoformat(),
-            "status": "online" if soc > 0 else "offline"
+            "version": st.version if st else 0,
+            "age_s": BESS.age(),
+            "status": "stale" if BESS.stale() else ("online" if soc > 0 else "offline")
         }
     except Exception as e:
         return {"error": f"Status-Fehler: {str(e)}", "status": 500}
 
 def soc_limits():
-    soc = float(r.get("telemetry:soc") or 100.0)
-    temp = float(r.get("telemetry:temp") or 25.0)
-    allow_buy = soc >= 15.0
-    allow_sell = soc <= 90.0
-    rps_scale = 0.5 if temp>40.0 else 1.0
-    return allow_buy, allow_sell, rps_scale, soc, temp
+    """(allow_buy, allow_sell, rps_scale, soc, temp) from the in-memory BESS state (no I/O)"""
+    return bess_limits(BESS.current, BESS.stale())
+
+STALE_MSG = "BESS telemetry stale: order entry suspended"
 
 # ---- Throttle with SoC scaling ----
-def throttle(api_key:str, market:str):
-    pol = load_policy()
-    base = pol.get("per_market_rps",{}).get(market, 120)
-    allow_buy, allow_sell, scale, *_ = soc_limits()
-    budget = max(1, int(base*scale))
-    now_min=int(time.time())//60; k=f"rps:{api_key}:{market}:{now_min}"
-    cnt=r.incr(k); r.expire(k,70)
-    remaining = max(0, budget - cnt)
-    if cnt>budget: raise HTTPException(429,f"per-market throttle exceeded for {market} (scaled by SoC/temp)")
+# Token bucket per (api_key, market): per_market_rps is the refill rate in orders per minute,
+# per_market_burst the bucket size (default: one minute of refill). Refill + charge is one Lua call.
+LIMITER = TokenBucketLimiter(r)
+def throttle_params(market:str) -> Tuple[float, float]:
+    return POLICY.current.limit(market)
+
+async def throttle_grant(api_key:str, market:str, n:int=1, scale:Optional[float]=None) -> Tuple[int, int]:
+    """Charge `n` requests against the market's token bucket; returns (granted, remaining).
+    Pass `scale` when the caller already read soc_limits() to save the telemetry round trip."""
+    if scale is None: _, _, scale, *_ = soc_limits()
+    rate, burst = throttle_params(market)
+    return await LIMITER.take(api_key, market, rate, burst, scale, n)
+
+async def throttle(api_key:str, market:str, scale:Optional[float]=None):
+    granted, remaining = await throttle_grant(api_key, market, scale=scale)
+    if not granted: raise HTTPException(429,f"per-market throttle exceeded for {market} (scaled by SoC/temp)")
     return remaining
 
 # ---- WS with HMAC signatures ----
-WS_BOOK=[]; WS_TRADES=[]; WS_ORDERS: Dict[str, List]= {}
+# Each socket is wrapped in a ws_hub.Client (bounded queue + writer task); emit_* only enqueue
+BOOK_SUBS = Subscriptions(); WS_TRADES: set = set(); WS_ORDERS: Dict[str, set] = {}
 from fastapi import WebSocket
 
-def sign_payload(payload: dict) -> dict:
-    kid = ACTIVE_KID
-    body = json.dumps(payload, separators=(',',':'))
-    ts = str(int(time.time()*1000))
-    mac = hmac.new(HMAC_KEYS[kid], (ts + "|" + body).encode(), hashlib.sha256).digest()
-    sig = base64.b64encode(mac).decode()
-    return {"ts": ts, "sig": sig, "algo":"HMAC-SHA256", "key_id": kid}
+# Events are serialized and signed once into a ready-to-send text frame shared by all subscribers.
+# The signature covers ts|data exactly as clients re-serialize it (json.dumps, compact separators).
+_JSON = json.JSONEncoder(separators=(',',':'))  # reused encoder: same bytes as json.dumps(..., separators)
+
+def _mac(kid: str, msg: str) -> str:
+    return base64.b64encode(hmac.new(HMAC_KEYS[kid], msg.encode(), hashlib.sha256).digest()).decode()
+
+class Frame:
+    """Prebuilt signed envelope {"meta":{...},"data":...}; per-user extras are added as meta.ext
+    with their own signature ext_sig = HMAC(ts|sig|ext) so the shared part is never re-signed"""
+    __slots__ = ("ts", "kid", "sig", "head", "tail", "text")
+    def __init__(self, payload: dict):
+        self.kid = ACTIVE_KID
+        body = _JSON.encode(payload)
+        self.ts = str(int(time.time()*1000))
+        self.sig = _mac(self.kid, self.ts + "|" + body)
+        self.head = '{"meta":{"ts":"%s","sig":"%s","algo":"HMAC-SHA256","key_id":%s' % (self.ts, self.sig, _JSON.encode(self.kid))
+        self.tail = '},"data":' + body + '}'
+        self.text = self.head + self.tail
+    def with_ext(self, ext: dict) -> str:
+        e = _JSON.encode(ext)
+        return self.head + ',"ext":' + e + ',"ext_sig":"' + _mac(self.kid, self.ts + "|" + self.sig + "|" + e) + '"' + self.tail
+
+async def send_frame(ws, text: str):
+    """Writer-side send of a prebuilt frame"""
+    await ws.send_text(text)
+
+def book_snapshot(market: str, product: Optional[str] = None) -> dict:
+    """Full-depth snapshot(s) with per-product sequence numbers (resync point for book deltas)"""
+    books = BOOKS.get(market, {})
+    if product is not None:
+        books = {product: books[product]} if product in books else {}
+    return {"type":"book_snapshot","market":market,"books":[b.snapshot() for b in books.values()]}
 
-async def ws_send(ws, payload: dict, meta_extra: dict = None):
-    meta = sign_payload(payload)
-    if meta_extra: meta.update(meta_extra)
-    await ws.send_json({"meta": meta, "data": payload})
+@app.get("/book/{market}")
+def get_book_snapshot(market: str, product: Optional[str] = None):
+    """REST resync: apply /ws/book deltas with seq > the snapshot's seq for that product"""
+    try: product = parse_product(product)
+    except ValueError: raise HTTPException(400, "product must be 'delivery_start/delivery_end' (ISO 8601)")
+    return book_snapshot(market, product)
 
+@app.get("/admin/ws/clients")
+def ws_clients():
+    """Per-client outbound queue length, lag and conflation counters"""
+    return {"clients": clients_info()}
+
+@app.websocket("/ws/book")
 @app.websocket("/ws/book/{market}")
-async def ws_book(ws: WebSocket, market: str):
-    await ws.accept(); WS_BOOK.append(ws)
+async def ws_book(ws: WebSocket, market: Optional[str] = None):
+    """Book stream. Control messages over the same socket:
+    {"op":"subscribe","market":"...","product":"..."} / {"op":"unsubscribe",...} (product optional).
+    Each subscribe is answered with a snapshot, then per-level deltas (emit_book)."""
+    await ws.accept()
+    client = Client(ws, "book", send_frame, snapshot=lambda m, p: Frame(book_snapshot(m, p)).text)
     try:
-        while True: await ws.receive_text()
+        if market:
+            BOOK_SUBS.subscribe(client, market)
+            client.push(Frame(book_snapshot(market)).text)
+        while True:
+            try: msg = json.loads(await ws.receive_text())
+            except ValueError: continue
+            if not isinstance(msg, dict) or not msg.get("market"): continue
+            m = msg["market"]
+            try: product = parse_product(msg.get("product"))
+            except ValueError: continue
+            if msg.get("op") == "subscribe":
+                BOOK_SUBS.subscribe(client, m, product)
+                client.push(Frame(book_snapshot(m, product)).text)
+            elif msg.get("op") == "unsubscribe":
+                BOOK_SUBS.unsubscribe(client, m, product)
+                client.push(Frame({"type":"unsubscribed","market":m,"product":product}).text)
     except WebSocketDisconnect:
-        if ws in WS_BOOK: WS_BOOK.remove(ws)
+        pass
+    finally:
+        BOOK_SUBS.drop(client); client.close()
 
 @app.websocket("/ws/trades")
 async def ws_trades(ws: WebSocket):
-    await ws.accept(); WS_TRADES.append(ws)
+    await ws.accept()
+    client = Client(ws, "trades", send_frame); WS_TRADES.add(client)
     try:
         while True: await ws.receive_text()
     except WebSocketDisconnect:
-        if ws in WS_TRADES: WS_TRADES.remove(ws)
+        pass
+    finally:
+        WS_TRADES.discard(client); client.close()
 
 @app.websocket("/ws/orders")
 async def ws_orders(ws: WebSocket):
     api_key = ws.query_params.get("api_key") or "demo"
     await ws.accept()
-    WS_ORDERS.setdefault(api_key, []).append(ws)
+    client = Client(ws, "orders", send_frame)
+    WS_ORDERS.setdefault(api_key, set()).add(client)
     try:
         while True: await ws.receive_text()
     except WebSocketDisconnect:
-        if ws in WS_ORDERS.get(api_key, []): WS_ORDERS[api_key].remove(ws)
+        pass
+    finally:
+        WS_ORDERS.get(api_key, set()).discard(client); client.close()
 
-async def emit_book(market:str):
-    payload={"type":"book","market":market,"bids":BOOK.get(market,{}).get("bids",[])[:10],"asks":BOOK.get(market,{}).get("asks",[])[:10]}
-    for ws in list(WS_BOOK):
-        try: await ws_send(ws, payload)
-        except: 
-            try: WS_BOOK.remove(ws)
-            except: pass
+async def emit_book(market:str, product:str="", delta:Optional[dict]=None):
+    """Publish changed levels (price, new size; 0 = removed) with the book's next sequence number
+    (`delta` taken earlier by the sequencer, published once its batch is durable)"""
+    if delta is None: delta = get_book(market, product).take_delta()
+    if delta is None: return
+    targets = BOOK_SUBS.targets(market, product)
+    if not targets: return
+    frame = Frame({"type":"book_delta","market":market,"product":product,**delta}).text
+    for client in targets:
+        # Lagging clients get the delta conflated into a resync snapshot of this book
+        if not client.push(frame, (market, product)): BOOK_SUBS.drop(client)
 
 async def emit_trade(trade:dict):
-    payload={"type":"trade", **trade}
-    for ws in list(WS_TRADES):
-        try: await ws_send(ws, payload)
-        except:
-            try: WS_TRADES.remove(ws)
-            except: pass
+    if not WS_TRADES: return
+    frame = Frame({"type":"trade", **trade}).text
+    for client in list(WS_TRADES):
+        if not client.push(frame): WS_TRADES.discard(client)
 
 async def emit_order(api_key:str, event:dict):
-    arr = WS_ORDERS.get(api_key, [])
+    clients = WS_ORDERS.get(api_key)
+    if not clients: return
     # include throttle remaining & short exposure snapshot
     remaining = throttle_remaining_cached(api_key, event.get("market",""))
     snapshot = exposure_of(api_key)
-    for ws in list(arr):
-        try: await ws_send(ws, {"type":"order", **event}, {"throttle_remaining": remaining, "exposure_snapshot": snapshot})
-        except:
-            try: arr.remove(ws)
-            except: pass
-    WS_ORDERS[api_key]=arr
-
-def throttle_remaining_cached(api_key:str, market:str):
-    pol = load_policy()
-    base = pol.get("per_market_rps",{}).get(market, 120)
-    _, _, scale, *_ = soc_limits()
-    budget = max(1, int(base*scale))
-    now_min=int(time.time())//60; k=f"rps:{api_key}:{market}:{now_min}"
-    cnt = int(r.get(k) or 0)
-    return max(0, budget - cnt)
+    text = Frame({"type":"order", **event}).with_ext({"throttle_remaining": remaining, "exposure_snapshot": snapshot})
+    for client in list(clients):
+        if not client.push(text): clients.discard(client)
+
+def throttle_remaining_cached(api_key:str, market:str) -> int:
+    """Tokens left as of the last charge plus local refill (no Redis); full bucket if never charged"""
+    return LIMITER.remaining(api_key, market, default=int(throttle_params(market)[1]))
 
 # ---- Pricefeed + metrics ----
+PRICES = PriceAggregator(r)  # per-market mark/EMA/rolling VWAP, checkpointed to Redis
+
 @app.post("/admin/pricefeed/push")
-def pricefeed_push(market: str, price: float, volume: float = 1.0):
-    key=f"price:stream:{market}"
+async def pricefeed_push(market: str, price: float, volume: float = 1.0):
     ts_ms = int(time.time()*1000)
-    r.xadd(key, {"p": price, "v": volume, "ts": ts_ms}, maxlen=10000, approximate=True)
-    r.set(f"price:mark:{market}", price)
-    # EMA
-    prev = r.get(f"price:ema:{market}"); prev = float(prev) if prev else price
-    alpha = 0.2
-    ema = alpha*price + (1-alpha)*prev
-    r.set(f"price:ema:{market}", ema)
-    # VWAP
-    entries = r.xrevrange(key, count=96)
-    num=0.0; den=0.0
-    for _, fields in entries:
-        p=float(fields[b"p"].decode()); v=float(fields.get(b"v",b"1").decode())
-        num += p*v; den += v
-    vwap = (num/den) if den>0 else price
-    r.set(f"price:vwap:{market}", vwap)
+    # Stream append + mark/EMA/VWAP keys in one round trip; VWAP comes from the in-process ring
+    mp = await PRICES.get(market, POLICY.current.vwap_window(market))
+    async with r.pipeline(transaction=False) as p:
+        _, ema, vwap = PRICES.write(p, mp, price, volume, ts_ms)
+        await p.execute()
     
     # Persist to SQLite for history - use single connection and transaction to avoid locks
     try:
-        con=db(); c=con.cursor()
-        # Insert new price data
-        c.execute("INSERT INTO market_price_history(market, mark, ema, vwap, timestamp, ts) VALUES(?,?,?,?,?,?)",
-                  (market, price, ema, vwap, ts_ms, datetime.utcnow().isoformat()))
-        # Keep only last 90 days of data (cleanup old entries for long-term analysis)
-        cutoff_ts = ts_ms - (90 * 24 * 60 * 60 * 1000)
-        c.execute("DELETE FROM market_price_history WHERE timestamp < ?", (cutoff_ts,))
-        # Commit both operations in one transaction
-        con.commit(); con.close()
+        await DB.run(_persist_price, market, price, ema, vwap)
     except sqlite3.OperationalError as e:
         if "locked" in str(e).lower():
             # Database is locked - skip this update, will retry on next price feed
@@ -345,94 +601,77 @@ def pricefeed_push(market: str, price: float, volume: float = 1.0):
         print(f"ERROR persisting price history: {e}")
         print(f"Traceback: {traceback.format_exc()}")
     
+    HISTORY_CACHE.bump(market)
+    SAMPLER.update(market, price, ema, vwap, ts_ms)
     G_MARK.labels(market).set(price); G_EMA.labels(market).set(ema); G_VWAP.labels(market).set(vwap); C_EVENTS.labels(market).inc()
     return {"status":"OK"}
 
+def _persist_price(con, market: str, price: float, ema: float, vwap: float):
+    """DB executor: insert one price point into its daily partition (retention: retention_loop);
+    the row timestamp is assigned here on the writer thread, not from the push (see PriceHistory.next_ts)"""
+    PRICE_HISTORY.insert(con, market, price, ema, vwap)
+    con.commit()
+
+def _persist_sample(con, market: str, mark: float, ema: float, vwap: float):
+    """DB executor: store one sampler reading (one per market and cadence; retention: retention_loop)"""
+    PRICE_HISTORY.insert(con, market, mark, ema, vwap)
+    con.commit()
+
+async def persist_sample(market: str, mark: float, ema: float, vwap: float):
+    await DB.run(_persist_sample, market, mark, ema, vwap)
+
+# Encoded /market/history(/longterm) responses; a new price of the market (pushed here or seen by the sampler) invalidates them
+HISTORY_CACHE = HistoryCache(float(os.getenv("HISTORY_CACHE_MAX_AGE_S","30")), int(os.getenv("HISTORY_CACHE_ENTRIES","256")))
+
+# Dashboards read the in-memory snapshot; only the per-market sampler writes history rows
+SAMPLER = PriceSampler(r, persist_sample, lambda m: POLICY.current.sample_interval(m), on_change=HISTORY_CACHE.bump)
+
+async def cached_history(fn, args: tuple, if_none_match: Optional[str]) -> Response:
+    """Response of read-pool query `fn(con, market, ...)` from HISTORY_CACHE; 304 if the client holds it"""
+    key = (fn.__name__,) + args; market = args[0]
+    e = HISTORY_CACHE.get(key, market)
+    if e is None:
+        version = HISTORY_CACHE.version(market)
+        result = await DB_READ.run(fn, *args)
+        body = _JSON.encode(result).encode()
+        if "error" in result:  # not cached: retried on the next request
+            return Response(body, media_type="application/json")
+        e = HISTORY_CACHE.put(key, version, body)
+        C_HCACHE.labels("miss").inc()
+    else:
+        C_HCACHE.labels("hit").inc()
+    headers = {"ETag": e.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, e.etag):
+        C_HCACHE.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
+    return Response(e.body, media_type="application/json", headers=headers)
+
 @app.get("/market/prices")
-def get_market_prices(market: str = "epex_at"):
-    """Get current market prices from Redis and persist to database for long-term analysis"""
-    try:
-        mark = round(float(r.get(f"price:mark:{market}") or 0.0), 2)
-        ema = round(float(r.get(f"price:ema:{market}") or mark), 2)
-        vwap = round(float(r.get(f"price:vwap:{market}") or mark), 2)
-        
-        # CRITICAL: Persist to database for long-term analysis
-        # This ensures data is available for /market/history/longterm endpoint
-        # Debug: Log what we're trying to persist
-        print(f"🔍 Persistence check: market={market}, mark={mark:.2f}, ema={ema:.2f}, vwap={vwap:.2f}, condition={mark > 0 and mark < 1000}")
-        if mark > 0 and mark < 1000:  # Only persist valid prices
-            try:
-                ts_ms = int(time.time() * 1000)
-                con = db()
-                c = con.cursor()
-                # Check if data for this timestamp already exists (avoid duplicates)
-                # Round timestamp to nearest second to avoid duplicate inserts
-                ts_second = (ts_ms // 1000) * 1000
-                c.execute("""
-                    SELECT COUNT(*) FROM market_price_history 
-                    WHERE market = ? AND timestamp >= ? AND timestamp < ?
-                """, (market, ts_second, ts_second + 1000))
-                exists = c.fetchone()[0] > 0
-                
-                if not exists:
-                    # Insert new price data only if it doesn't exist
-                    c.execute("""
-                        INSERT INTO market_price_history(market, mark, ema, vwap, timestamp, ts) 
-                        VALUES(?,?,?,?,?,?)
-                    """, (market, mark, ema, vwap, ts_ms, datetime.utcnow().isoformat()))
-                    
-                    # Debug: Log successful insert (every insert for now to debug)
-                    c.execute("SELECT COUNT(*) FROM market_price_history WHERE market = ?", (market,))
-                    total_count = c.fetchone()[0]
-                    print(f"✅ Market price persisted: market={market}, mark={mark:.2f}, ema={ema:.2f}, vwap={vwap:.2f}, timestamp={ts_ms}, total_records={total_count}")
-                else:
-                    print(f"⚠️ Duplicate timestamp skipped: market={market}, timestamp={ts_ms}")
-                
-                # Keep only last 90 days of data (cleanup old entries)
-                cutoff_ts = ts_ms - (90 * 24 * 60 * 60 * 1000)
-                c.execute("DELETE FROM market_price_history WHERE timestamp < ?", (cutoff_ts,))
-                deleted = c.rowcount
-                if deleted > 0:
-                    print(f"Cleaned up {deleted} old market_price_history records (older than 90 days)")
-                con.commit()
-                con.close()
-            except Exception as db_error:
-                # Log but don't fail the request if database write fails
-                import traceback
-                print(f"❌ Warning: Failed to persist market price to database: {db_error}")
-                print(f"❌ Traceback: {traceback.format_exc()}")
-        else:
-            print(f"⚠️ Skipping persistence: mark={mark:.2f} is not in valid range (0 < mark < 1000)")
-        
+async def get_market_prices(market: str = "epex_at"):
+    """Current market prices from the in-memory snapshot (no Redis or database access)"""
+    snap = SAMPLER.snapshot.get(market)
+    if snap is None: SAMPLER.track(market)  # first request for a market pushed elsewhere: sampler picks it up
+    if snap is None or round(snap[0], 2) == 0.0:
         # If no data, return default values
-        if mark == 0.0:
-            return {
-                "mark": 85.50,
-                "ema": 84.20,
-                "vwap": 85.10,
-                "timestamp": datetime.now().isoformat(),
-                "market": market
-            }
-        
-        return {
-            "mark": mark,
-            "ema": ema,
-            "vwap": vwap,
-            "timestamp": datetime.now().isoformat(),
-            "market": market
-        }
-    except Exception as e:
         return {
             "mark": 85.50,
             "ema": 84.20,
             "vwap": 85.10,
             "timestamp": datetime.now().isoformat(),
-            "market": market,
-            "error": str(e)
+            "market": market
         }
+    mark, ema, vwap, _ = snap
+    return {
+        "mark": round(mark, 2),
+        "ema": round(ema, 2),
+        "vwap": round(vwap, 2),
+        "timestamp": datetime.now().isoformat(),
+        "market": market
+    }
 
 @app.get("/market/history")
-def get_market_history(market: str = "epex_at", hours: int = 1, limit: int = 360, aggregated: bool = False):
+async def get_market_history(market: str = "epex_at", hours: int = 1, limit: int = 360, aggregated: bool = False,
+                             if_none_match: Optional[str] = Header(default=None)):
     """Get market price history from database
     
     Args:
@@ -442,52 +681,39 @@ def get_market_history(market: str = "epex_at", hours: int = 1, limit: int = 360
         aggregated: If True, aggregate data for longer periods (default: False)
     
     Returns:
-        List of price history entries
+        List of price history entries (cached; ETag / If-None-Match -> 304)
     """
+    return await cached_history(_market_history, (market, hours, limit, aggregated), if_none_match)
+
+def _market_history(con, market: str, hours: int, limit: int, aggregated: bool):
+    """Read pool: query behind get_market_history"""
     try:
         cutoff_ts = int(time.time() * 1000) - (hours * 60 * 60 * 1000)
-        con = db()
         c = con.cursor()
         
         if aggregated and hours > 24:
-            # For longer periods, aggregate by hour
-            c.execute("""
-                SELECT 
-                    (timestamp / 3600000) * 3600000 as hour_timestamp,
-                    AVG(mark) as mark,
-                    AVG(ema) as ema,
-                    AVG(vwap) as vwap,
-                    MIN(mark) as mark_min,
-                    MAX(mark) as mark_max,
-                    COUNT(*) as data_points
-                FROM market_price_history 
-                WHERE market = ? AND timestamp >= ?
-                GROUP BY hour_timestamp
-                ORDER BY hour_timestamp ASC
-                LIMIT ?
-            """, (market, cutoff_ts, limit))
-            rows = c.fetchall()
+            # For longer periods, aggregate by hour (from the hourly rollup)
             history = []
-            for row in rows:
+            for row in rollup(con, market, cutoff_ts, 3600000, limit=limit):
                 history.append({
-                    "timestamp": int(row["hour_timestamp"]),
-                    "mark": round(row["mark"], 2),
-                    "ema": round(row["ema"], 2),
-                    "vwap": round(row["vwap"], 2),
-                    "mark_min": round(row["mark_min"], 2),
-                    "mark_max": round(row["mark_max"], 2),
-                    "data_points": row["data_points"],
-                    "ts": datetime.fromtimestamp(row["hour_timestamp"] / 1000).isoformat()
+                    "timestamp": int(row["bucket"]),
+                    "mark": round(row["mark_avg"], 2),
+                    "ema": round(row["ema_avg"], 2),
+                    "vwap": round(row["vwap_avg"], 2),
+                    "mark_min": round(row["mark_low"], 2),
+                    "mark_max": round(row["mark_high"], 2),
+                    "data_points": row["n"],
+                    "ts": datetime.fromtimestamp(row["bucket"] / 1000).isoformat()
                 })
         else:
             # Original granular data
-            c.execute("""
+            src, params = history_source(con, market, cutoff_ts)
+            c.execute(f"""
                 SELECT timestamp, mark, ema, vwap, ts 
-                FROM market_price_history 
-                WHERE market = ? AND timestamp >= ?
+                FROM {src} 
                 ORDER BY timestamp ASC
                 LIMIT ?
-            """, (market, cutoff_ts, limit))
+            """, params + [limit])
             rows = c.fetchall()
             history = []
             for row in rows:
@@ -499,7 +725,6 @@ def get_market_history(market: str = "epex_at", hours: int = 1, limit: int = 360
                     "ts": row["ts"]
                 })
         
-        con.close()
         return {
             "market": market,
             "count": len(history),
@@ -514,26 +739,37 @@ def get_market_history(market: str = "epex_at", hours: int = 1, limit: int = 360
             "error": str(e)
         }
 
+LONGTERM_INTERVALS = {"minute": 60 * 1000, "15min": 15 * 60 * 1000, "hour": 60 * 60 * 1000, "day": 24 * 60 * 60 * 1000}
+LONGTERM_MAX_BUCKETS = int(os.getenv("LONGTERM_MAX_BUCKETS","3000"))  # finer aggregations over long ranges are coarsened
+
 @app.get("/market/history/longterm")
-def get_longterm_history(market: str = "epex_at", days: int = 7, aggregation: str = "hour"):
+async def get_longterm_history(market: str = "epex_at", days: int = 7, aggregation: str = "hour",
+                               if_none_match: Optional[str] = Header(default=None)):
     """Get aggregated long-term market price history
     
     Args:
         market: Market identifier
         days: Number of days to retrieve (1, 7, 30, 90)
-        aggregation: Aggregation level - 'hour' or 'day' (default: 'hour')
+        aggregation: Aggregation level - 'minute', '15min', 'hour' or 'day' (default: 'hour');
+                     coarsened if the range would exceed LONGTERM_MAX_BUCKETS buckets (see interval_ms)
     
     Returns:
-        Aggregated price history with statistics
+        Aggregated price history with statistics (cached; ETag / If-None-Match -> 304)
     """
+    return await cached_history(_longterm_history, (market, days, aggregation), if_none_match)
+
+def _longterm_history(con, market: str, days: int, aggregation: str):
+    """Read pool: query behind get_longterm_history (served from the price rollups)"""
     try:
-        cutoff_ts = int(time.time() * 1000) - (days * 24 * 60 * 60 * 1000)
-        con = db()
-        c = con.cursor()
+        if aggregation not in LONGTERM_INTERVALS: aggregation = "hour"
+        # Cutoff on a bucket boundary: the body (and its ETag) only changes with the data or a new bucket
+        interval = fit_interval(days * 24 * 60 * 60 * 1000, LONGTERM_INTERVALS[aggregation], LONGTERM_MAX_BUCKETS)
+        used = next(k for k, v in LONGTERM_INTERVALS.items() if v == interval)
+        cutoff_ts = (int(time.time() * 1000) - (days * 24 * 60 * 60 * 1000)) // interval * interval
         
-        # Check if table exists
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='market_price_history'")
-        if not c.fetchone():
+        # Totals come from the daily rollup (<= retention days rows), not from raw tick scans
+        total_records, min_ts, max_ts = rollup_totals(con, market)
+        if not total_records and not list_partitions(con):
             return {
                 "market": market,
                 "days": days,
@@ -543,120 +779,42 @@ def get_longterm_history(market: str = "epex_at", days: int = 7, aggregation: st
                 "error": "Table market_price_history does not exist yet. Data will be available after first price feed."
             }
         
-        # DEBUG: Check total records in database
-        c.execute("SELECT COUNT(*) as total FROM market_price_history WHERE market = ?", (market,))
-        total_records = c.fetchone()["total"]
-        c.execute("SELECT COUNT(*) as total FROM market_price_history WHERE market = ? AND timestamp >= ?", (market, cutoff_ts))
-        records_in_range = c.fetchone()["total"]
-        c.execute("SELECT MIN(timestamp) as min_ts, MAX(timestamp) as max_ts FROM market_price_history WHERE market = ?", (market,))
-        ts_range = c.fetchone()
-        
-        print(f"DEBUG longterm: market={market}, days={days}, total_records={total_records}, records_in_range={records_in_range}, min_ts={ts_range['min_ts']}, max_ts={ts_range['max_ts']}, cutoff_ts={cutoff_ts}")
-        
-        if aggregation == "day":
-            # Aggregate by day
-            interval_ms = 24 * 60 * 60 * 1000
-            c.execute("""
-                SELECT 
-                    (timestamp / ?) * ? as day_timestamp,
-                    AVG(mark) as mark_avg,
-                    AVG(ema) as ema_avg,
-                    AVG(vwap) as vwap_avg,
-                    MIN(mark) as mark_min,
-                    MAX(mark) as mark_max,
-                    MIN(ema) as ema_min,
-                    MAX(ema) as ema_max,
-                    COUNT(*) as data_points
-                FROM market_price_history 
-                WHERE market = ? AND timestamp >= ?
-                GROUP BY day_timestamp
-                ORDER BY day_timestamp ASC
-            """, (interval_ms, interval_ms, market, cutoff_ts))
-        else:
-            # Aggregate by hour (default)
-            interval_ms = 60 * 60 * 1000
-            c.execute("""
-                SELECT 
-                    (timestamp / ?) * ? as hour_timestamp,
-                    AVG(mark) as mark_avg,
-                    AVG(ema) as ema_avg,
-                    AVG(vwap) as vwap_avg,
-                    MIN(mark) as mark_min,
-                    MAX(mark) as mark_max,
-                    MIN(ema) as ema_min,
-                    MAX(ema) as ema_max,
-                    COUNT(*) as data_points
-                FROM market_price_history 
-                WHERE market = ? AND timestamp >= ?
-                GROUP BY hour_timestamp
-                ORDER BY hour_timestamp ASC
-            """, (interval_ms, interval_ms, market, cutoff_ts))
-        
-        rows = c.fetchall()
-        con.close()
-        
         history = []
-        for row in rows:
-            # SQLite Row objects - access by column name or index
-            if aggregation == "day":
-                entry = {
-                    "timestamp": int(row["day_timestamp"]),
-                    "mark": round(row["mark_avg"], 2),
-                    "ema": round(row["ema_avg"], 2),
-                    "vwap": round(row["vwap_avg"], 2),
-                    "mark_min": round(row["mark_min"], 2),
-                    "mark_max": round(row["mark_max"], 2),
-                    "ema_min": round(row["ema_min"], 2) if row["ema_min"] is not None else None,
-                    "ema_max": round(row["ema_max"], 2) if row["ema_max"] is not None else None,
-                    "data_points": row["data_points"],
-                    "ts": datetime.fromtimestamp(int(row["day_timestamp"]) / 1000).isoformat()
-                }
-            else:
-                entry = {
-                    "timestamp": int(row["hour_timestamp"]),
-                    "mark": round(row["mark_avg"], 2),
-                    "ema": round(row["ema_avg"], 2),
-                    "vwap": round(row["vwap_avg"], 2),
-                    "mark_min": round(row["mark_min"], 2),
-                    "mark_max": round(row["mark_max"], 2),
-                    "ema_min": round(row["ema_min"], 2) if row["ema_min"] is not None else None,
-                    "ema_max": round(row["ema_max"], 2) if row["ema_max"] is not None else None,
-                    "data_points": row["data_points"],
-                    "ts": datetime.fromtimestamp(int(row["hour_timestamp"]) / 1000).isoformat()
-                }
-            history.append(entry)
+        for row in rollup(con, market, cutoff_ts, interval):
+            history.append({
+                "timestamp": int(row["bucket"]),
+                "mark": round(row["mark_avg"], 2),
+                "ema": round(row["ema_avg"], 2),
+                "vwap": round(row["vwap_avg"], 2),
+                "mark_open": round(row["mark_open"], 2),
+                "mark_close": round(row["mark_close"], 2),
+                "mark_min": round(row["mark_low"], 2),
+                "mark_max": round(row["mark_high"], 2),
+                "ema_min": round(row["ema_low"], 2),
+                "ema_max": round(row["ema_high"], 2),
+                "data_points": row["n"],
+                "ts": datetime.fromtimestamp(row["bucket"] / 1000).isoformat()
+            })
         
-        result = {
+        return {
             "market": market,
             "days": days,
             "aggregation": aggregation,
+            "interval_ms": interval,
             "count": len(history),
             "history": history,
             "debug": {
                 "total_records": total_records,
-                "records_in_range": records_in_range,
-                "min_timestamp": ts_range["min_ts"],
-                "max_timestamp": ts_range["max_ts"],
-                "cutoff_timestamp": cutoff_ts
+                "records_in_range": sum(h["data_points"] for h in history),
+                "min_timestamp": min_ts,
+                "max_timestamp": max_ts,
+                "cutoff_timestamp": cutoff_ts,
+                "cutoff_date": datetime.fromtimestamp(cutoff_ts / 1000).isoformat() if cutoff_ts else None,
+                "min_date": datetime.fromtimestamp(min_ts / 1000).isoformat() if min_ts else None,
+                "max_date": datetime.fromtimestamp(max_ts / 1000).isoformat() if max_ts else None,
+                "query_used": used
             }
         }
-        print(f"DEBUG longterm result: count={len(history)}, first_entry={history[0] if history else None}")
-        
-        # Enhanced debug info
-        result["debug"] = {
-            "total_records": total_records,
-            "records_in_range": records_in_range,
-            "min_timestamp": ts_range["min_ts"],
-            "max_timestamp": ts_range["max_ts"],
-            "cutoff_timestamp": cutoff_ts,
-            "cutoff_date": datetime.fromtimestamp(cutoff_ts / 1000).isoformat() if cutoff_ts else None,
-            "min_date": datetime.fromtimestamp(ts_range["min_ts"] / 1000).isoformat() if ts_range["min_ts"] else None,
-            "max_date": datetime.fromtimestamp(ts_range["max_ts"] / 1000).isoformat() if ts_range["max_ts"] else None,
-            "current_time": datetime.now().isoformat(),
-            "query_used": "day" if aggregation == "day" else "hour"
-        }
-        
-        return result
     except Exception as e:
         import traceback
         return {
@@ -670,15 +828,18 @@ def get_longterm_history(market: str = "epex_at", days: int = 7, aggregation: st
         }
 
 @app.get("/market/history/debug")
-def debug_market_history(market: str = "epex_at"):
+async def debug_market_history(market: str = "epex_at"):
     """Debug endpoint to check database contents"""
+    return await DB_READ.run(_debug_market_history, market)
+
+def _debug_market_history(con, market: str):
+    """Read pool: query behind debug_market_history"""
     try:
-        con = db()
         c = con.cursor()
         
         # Check if table exists
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='market_price_history'")
-        table_exists = c.fetchone() is not None
+        partitions = list_partitions(con)
+        table_exists = bool(partitions)
         
         if not table_exists:
             return {
@@ -686,39 +847,38 @@ def debug_market_history(market: str = "epex_at"):
                 "error": "Table market_price_history does not exist"
             }
         
+        src, params = history_source(con, market, 0)
         # Get total count
-        c.execute("SELECT COUNT(*) as total FROM market_price_history WHERE market = ?", (market,))
+        c.execute(f"SELECT COUNT(*) as total FROM {src}", params)
         total = c.fetchone()["total"]
         
         # Get time range
-        c.execute("SELECT MIN(timestamp) as min_ts, MAX(timestamp) as max_ts FROM market_price_history WHERE market = ?", (market,))
+        c.execute(f"SELECT MIN(timestamp) as min_ts, MAX(timestamp) as max_ts FROM {src}", params)
         ts_range = c.fetchone()
         
         # Get last 10 records
-        c.execute("""
+        c.execute(f"""
             SELECT timestamp, mark, ema, vwap, ts 
-            FROM market_price_history 
-            WHERE market = ? 
+            FROM {src} 
             ORDER BY timestamp DESC 
             LIMIT 10
-        """, (market,))
+        """, params)
         recent = [dict(row) for row in c.fetchall()]
         
         # Get first 10 records
-        c.execute("""
+        c.execute(f"""
             SELECT timestamp, mark, ema, vwap, ts 
-            FROM market_price_history 
-            WHERE market = ? 
+            FROM {src} 
             ORDER BY timestamp ASC 
             LIMIT 10
-        """, (market,))
+        """, params)
         oldest = [dict(row) for row in c.fetchall()]
         
-        con.close()
         
         return {
             "table_exists": True,
             "market": market,
+            "partitions": len(partitions),
             "total_records": total,
             "min_timestamp": ts_range["min_ts"],
             "max_timestamp": ts_range["max_ts"],
@@ -735,87 +895,139 @@ def debug_market_history(market: str = "epex_at"):
             "traceback": traceback.format_exc()
         }
 
+SYNC_PAGE_MAX = 5000        # rows per page
+SYNC_STREAM_MAX = 1000000   # rows per streamed (ndjson/binary) response
+_SYNC_ROW = struct.Struct("<qqddd")  # timestamp, id, mark, ema, vwap
+
+def sync_cursor(market: str, ts: int, rid: int) -> str:
+    """Opaque continuation token for the (timestamp, id) watermark of a market"""
+    return base64.urlsafe_b64encode(f"{market}|{ts}|{rid}".encode()).decode().rstrip("=")
+
+def parse_sync_cursor(token: str, market: str) -> Tuple[int, int]:
+    try:
+        m, ts, rid = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode().split("|")
+        ts, rid = int(ts), int(rid)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(400, "invalid cursor")
+    if m != market: raise HTTPException(400, "cursor belongs to another market")
+    return ts, rid
+
+def body_int(value, name: str) -> int:
+    """int() of a client-supplied JSON value: 400 instead of a 500 on null or non-numeric input"""
+    try: return int(value)
+    except (TypeError, ValueError, OverflowError): raise HTTPException(400, f"{name} must be an integer")
+
+def sync_watermark(data: dict, market: str) -> Tuple[int, int]:
+    """Position to resume after: cursor token > explicit {timestamp, id} > legacy client state"""
+    if data.get("cursor"): return parse_sync_cursor(str(data["cursor"]), market)
+    after = data.get("after")
+    if isinstance(after, dict): return body_int(after.get("timestamp", 0), "after.timestamp"), body_int(after.get("id", -1), "after.id")
+    if after is not None: raise HTTPException(400, "after must be an object {timestamp, id}")
+    # Legacy clients (client_history / last_sync): everything newer than what they hold, at most 24 h back
+    history = data.get("client_history") or []
+    if not isinstance(history, list) or not all(isinstance(p, dict) for p in history):
+        raise HTTPException(400, "client_history must be a list of objects")
+    newest = max((body_int(p.get("timestamp", 0), "client_history[].timestamp") for p in history), default=None)
+    floor = int(time.time() * 1000) - (24 * 60 * 60 * 1000)
+    if newest is not None: return max(newest, floor), 1 << 62  # rows with a larger timestamp only
+    return max(body_int(data.get("last_sync") or 0, "last_sync"), floor), -1
+
 @app.post("/market/history/sync")
-def sync_market_history(data: dict = Body(...)):
-    """Sync client-side history with server
+async def sync_market_history(data: dict = Body(...)):
+    """Sync client-side history with server (cursor protocol)
     
     Args in body:
         market: Market identifier
-        client_history: Array of {timestamp, mark, ema, vwap} entries
-        last_sync: Last sync timestamp (optional)
+        cursor: Token returned by the previous sync (optional)
+        after: Explicit watermark {timestamp, id} instead of a cursor (optional)
+        limit: Page size for JSON (default 1000, max 5000)
+        format: 'json' (one page), 'ndjson' or 'binary' (streamed pages)
+        max_rows: Row cap of a streamed response (default 1000000)
+    
+    Without cursor/after the sync starts 24 h back (legacy client_history/last_sync are honoured).
     
     Returns:
-        Server history that client doesn't have
+        json: {history, count, cursor, more, synced_at}; pass `cursor` back, repeat while `more`
+        ndjson: one row object per line, then {"cursor":...,"more":...}
+        binary: frames <u32 n><n x (i64 timestamp, i64 id, f64 mark, f64 ema, f64 vwap)> (little-endian),
+                ended by n=0 followed by <u16 len><cursor utf-8><u8 more>
     """
-    try:
-        market = data.get("market", "epex_at")
-        client_history = data.get("client_history", [])
-        last_sync = data.get("last_sync", 0)
-        
-        # Get client timestamps
-        client_timestamps = {int(p.get("timestamp", 0)) for p in client_history}
-        
-        # Get server history newer than last_sync
-        cutoff_ts = max(last_sync, int(time.time() * 1000) - (24 * 60 * 60 * 1000))
-        con = db()
-        c = con.cursor()
-        
-        if client_timestamps:
-            # Exclude timestamps that client already has
-            placeholders = ",".join("?" * len(client_timestamps))
-            c.execute(f"""
-                SELECT timestamp, mark, ema, vwap, ts 
-                FROM market_price_history 
-                WHERE market = ? AND timestamp >= ? AND timestamp NOT IN ({placeholders})
-                ORDER BY timestamp ASC
-                LIMIT 1000
-            """, [market, cutoff_ts] + list(client_timestamps))
+    market = data.get("market", "epex_at")
+    if not isinstance(market, str): raise HTTPException(400, "market must be a string")
+    fmt = data.get("format", "json")
+    ts, rid = sync_watermark(data, market)
+    if fmt == "json":
+        limit = max(1, min(body_int(data.get("limit", 1000), "limit"), SYNC_PAGE_MAX))
+        rows = await DB_READ.run(page_after, market, ts, rid, limit + 1)
+        more = len(rows) > limit; rows = rows[:limit]
+        if rows: ts, rid = rows[-1]["timestamp"], rows[-1]["id"]
+        history = [{"id": r["id"], "timestamp": r["timestamp"], "mark": r["mark"], "ema": r["ema"], "vwap": r["vwap"], "ts": r["ts"]}
+                   for r in rows]
+        return {"market": market, "count": len(history), "history": history, "cursor": sync_cursor(market, ts, rid),
+                "more": more, "synced_at": int(time.time() * 1000)}
+    if fmt not in ("ndjson", "binary"): raise HTTPException(400, "format must be json, ndjson or binary")
+    max_rows = max(1, min(body_int(data.get("max_rows", SYNC_STREAM_MAX), "max_rows"), SYNC_STREAM_MAX))
+    return StreamingResponse(_sync_stream(market, ts, rid, max_rows, fmt == "binary"),
+                             media_type="application/octet-stream" if fmt == "binary" else "application/x-ndjson")
+
+async def _sync_stream(market: str, ts: int, rid: int, max_rows: int, binary: bool):
+    """Page through the read pool, encoding each page as it arrives (one page in memory at a time)"""
+    sent = 0; more = False
+    while sent < max_rows:
+        n = min(SYNC_PAGE_MAX, max_rows - sent)
+        rows = await DB_READ.run(page_after, market, ts, rid, n + 1)
+        more = len(rows) > n; rows = rows[:n]
+        if not rows: break
+        ts, rid = rows[-1]["timestamp"], rows[-1]["id"]; sent += len(rows)
+        if binary:
+            yield struct.pack("<I", len(rows)) + b"".join(_SYNC_ROW.pack(r["timestamp"], r["id"], r["mark"], r["ema"], r["vwap"]) for r in rows)
         else:
-            # No client timestamps, return all since cutoff
-            c.execute("""
-                SELECT timestamp, mark, ema, vwap, ts 
-                FROM market_price_history 
-                WHERE market = ? AND timestamp >= ?
-                ORDER BY timestamp ASC
-                LIMIT 1000
-            """, (market, cutoff_ts))
-        
-        rows = c.fetchall()
-        con.close()
-        
-        server_history = []
-        for row in rows:
-            server_history.append({
-                "timestamp": row["timestamp"],
-                "mark": row["mark"],
-                "ema": row["ema"],
-                "vwap": row["vwap"],
-                "ts": row["ts"]
-            })
-        
-        return {
-            "market": market,
-            "count": len(server_history),
-            "history": server_history,
-            "synced_at": int(time.time() * 1000)
-        }
-    except Exception as e:
-        return {
-            "market": market,
-            "count": 0,
-            "history": [],
-            "error": str(e)
-        }
+            yield "".join(_JSON.encode({"id": r["id"], "timestamp": r["timestamp"], "mark": r["mark"], "ema": r["ema"],
+                                        "vwap": r["vwap"], "ts": r["ts"]}) + "\n" for r in rows)
+        if not more: break
+    cursor = sync_cursor(market, ts, rid)
+    if binary:
+        c = cursor.encode(); yield struct.pack("<IH", 0, len(c)) + c + struct.pack("<B", more)
+    else:
+        yield _JSON.encode({"cursor": cursor, "more": more}) + "\n"
+
+@app.get("/market/export/{dataset}")
+async def export_history(dataset: Literal["prices", "trades", "orderbook"], market: str = "epex_at",
+                         start: Optional[int] = None, end: Optional[int] = None,
+                         format: Literal["arrow", "parquet", "f64"] = "arrow", product: Optional[str] = None):
+    """Bulk export of a history range in columnar form, streamed page by page
+    
+    Args:
+        dataset: 'prices' (timestamp, mark, ema, vwap), 'trades' (timestamp, side, quantity, price)
+                 or 'orderbook' (timestamp, side, level, price, quantity; one row per book level)
+        market: Market identifier
+        start, end: Range [start, end) in epoch ms (default: the last 24 h)
+        format: 'arrow' (IPC stream), 'parquet' or 'f64' (raw little-endian float64 rows,
+                columns as listed in X-Export-Columns; needs no pyarrow)
+        product: Delivery product of the order book snapshots (orderbook only, optional)
+    
+    side is +1 for buy/bid and -1 for sell/ask.
+    """
+    if format != "f64" and history_export.pa is None:
+        raise HTTPException(501, "pyarrow not installed on the exchange, use format=f64")
+    end = int(time.time() * 1000) if end is None else end
+    start = end - 24 * 60 * 60 * 1000 if start is None else start
+    if start >= end: raise HTTPException(400, "start must be before end")
+    columns = ",".join(name for name, _ in history_export.DATASETS[dataset].columns)
+    ext = {"arrow": "arrows", "parquet": "parquet", "f64": "f64"}[format]
+    return StreamingResponse(history_export.stream(DB_READ.run, dataset, market, start, end, format, product),
+                             media_type=history_export.MEDIA_TYPES[format],
+                             headers={"X-Export-Columns": columns,
+                                      "Content-Disposition": f'attachment; filename="{dataset}_{market}_{start}_{end}.{ext}"'})
 
 # ---- Book injection ----
 @app.post("/admin/book_inject")
-async def book_inject(market: str = Body(...), bids: List[List[float]] = Body(default=[]), asks: List[List[float]] = Body(default=[])):
-    ensure_market(market)
-    BOOK[market]["bids"] = sorted([(float(p), float(q)) for p,q in bids], key=lambda x: (-x[0],))
-    BOOK[market]["asks"] = sorted([(float(p), float(q)) for p,q in asks], key=lambda x: (x[0],))
-    persist_book(market)
-    await emit_book(market)
-    return {"status":"OK"}
+async def book_inject(market: str = Body(...), bids: List[List[float]] = Body(default=[]), asks: List[List[float]] = Body(default=[]),
+                      delivery_start: Optional[str] = Body(default=None), delivery_end: Optional[str] = Body(default=None)):
+    product = product_key(delivery_start, delivery_end); now = datetime.utcnow().isoformat()
+    orders = [["inj-"+uuid.uuid4().hex, side, float(p), float(q), now] for side, levels in (("BUY", bids), ("SELL", asks)) for p, q in levels]
+    await get_sequencer(market, process_batch).submit({"op":"inject","product":product,"orders":orders})
+    return {"status":"OK","product":product}
 
 # ---- Orders with SoC gates + throttle scaling ----
 class OrderIn(BaseModel):
@@ -832,106 +1044,247 @@ class OrderIn(BaseModel):
 
 @app.post("/orders")
 async def create_order(o: OrderIn, user: User = Depends(get_user)):
-    allow_buy, allow_sell, _, soc, temp = soc_limits()
+    if BESS.stale(): raise HTTPException(503, STALE_MSG)
+    allow_buy, allow_sell, scale, soc, temp = soc_limits()
     if o.side=="BUY" and not allow_buy:
         raise HTTPException(400, f"BUY disabled at SoC {soc:.1f}% (<15%)")
     if o.side=="SELL" and not allow_sell:
         raise HTTPException(400, f"SELL disabled at SoC {soc:.1f}% (>90%)")
-    remaining = throttle(user.api_key, o.market)  # raises if over budget
+    remaining = await throttle(user.api_key, o.market, scale)  # raises if over budget
     oid=uuid.uuid4().hex; now=datetime.utcnow().isoformat()
-    con=db(); c=con.cursor()
-    c.execute("""INSERT INTO orders(id,user_key,market,side,type,tif,p_limit,qty,d_start,d_end,status,filled,ts)
-              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)""", (oid,user.api_key,o.market,o.side,o.order_type,o.time_in_force,o.limit_price_eur_mwh,o.quantity_mwh,o.delivery_start,o.delivery_end,"ACCEPTED",0.0,now))
-    con.commit(); con.close()
+    # Persist + match through the market's single-writer sequencer
+    res = await get_sequencer(o.market, process_batch).submit({"op":"new","order_id":oid,"user_key":user.api_key,"order":o,"ts":now})
     asyncio.create_task(emit_order(user.api_key, {"event":"ACCEPTED","order_id":oid,"market":o.market}))
-    exposure_of(user.api_key)
     
-    # Try to match the new order
-    asyncio.create_task(try_match_order(oid, o.market, o.side, o.quantity_mwh, o.limit_price_eur_mwh))
-    
-    return {"order_id":oid,"status":"ACCEPTED","timestamp":now,"throttle_remaining":remaining}
+    return {"order_id":oid,"status":"ACCEPTED","timestamp":now,"throttle_remaining":remaining,"seq":res["seq"],"filled":res["filled"]}
 
-async def try_match_order(new_order_id: str, market: str, side: str, quantity: float, limit_price: float):
-    """Simple matching engine - matches against opposite side orders"""
-    con=db(); c=con.cursor()
-    
-    # Find matching orders (opposite side, acceptable price)
-    opposite_side = "SELL" if side == "BUY" else "BUY"
-    
-    if side == "BUY":
-        # For BUY: find SELL orders where ask_price <= limit_price
-        c.execute("""SELECT id, user_key, qty, p_limit FROM orders 
-                     WHERE market=? AND side=? AND status='ACCEPTED' AND filled < qty 
-                     AND p_limit <= ? ORDER BY p_limit ASC, ts ASC""", 
-                  (market, opposite_side, limit_price))
+MAX_BATCH_ORDERS = int(os.getenv("MAX_BATCH_ORDERS","2000"))
+class OrderBatchIn(BaseModel):
+    orders: List[OrderIn]
+
+@app.post("/orders/batch")
+async def create_orders_batch(b: OrderBatchIn, user: User = Depends(get_user)):
+    """Submit a ladder of orders: validated together, throttle charged once per market,
+    one transaction and one sequenced match pass per market. Returns per-item results."""
+    if not b.orders: raise HTTPException(400, "empty batch")
+    if len(b.orders) > MAX_BATCH_ORDERS: raise HTTPException(413, f"batch exceeds {MAX_BATCH_ORDERS} orders")
+    if BESS.stale(): raise HTTPException(503, STALE_MSG)
+    allow_buy, allow_sell, scale, soc, temp = soc_limits()
+    results: List[Optional[dict]] = [None]*len(b.orders)
+    by_market: Dict[str, List[int]] = {}
+    for i, o in enumerate(b.orders):
+        if o.side=="BUY" and not allow_buy:
+            results[i] = {"index":i,"status":"REJECTED","error":f"BUY disabled at SoC {soc:.1f}% (<15%)"}
+        elif o.side=="SELL" and not allow_sell:
+            results[i] = {"index":i,"status":"REJECTED","error":f"SELL disabled at SoC {soc:.1f}% (>90%)"}
+        else:
+            by_market.setdefault(o.market, []).append(i)
+    now=datetime.utcnow().isoformat(); remaining_by_market={}; pending=[]
+    for market, idx in by_market.items():
+        granted, remaining_by_market[market] = await throttle_grant(user.api_key, market, len(idx), scale)
+        for i in idx[granted:]:
+            results[i] = {"index":i,"status":"REJECTED","error":f"per-market throttle exceeded for {market} (scaled by SoC/temp)"}
+        items = [(uuid.uuid4().hex, b.orders[i]) for i in idx[:granted]]
+        if items:
+            fut = get_sequencer(market, process_batch).submit({"op":"batch","user_key":user.api_key,"items":items,"ts":now})
+            pending.append((market, idx[:granted], fut))
+    for market, idx, fut in pending:
+        item_results = await fut
+        for i, res in zip(idx, item_results):
+            if isinstance(res, Exception):
+                results[i] = {"index":i,"status":"REJECTED","error":str(res)}
+            else:
+                results[i] = {"index":i,"status":"ACCEPTED",**res}
+        accepted = [res["order_id"] for res in item_results if not isinstance(res, Exception)]
+        asyncio.create_task(emit_order(user.api_key, {"event":"ACCEPTED","order_ids":accepted,"market":market}))
+    n_ok = sum(1 for x in results if x["status"]=="ACCEPTED")
+    return {"accepted":n_ok,"rejected":len(results)-n_ok,"timestamp":now,"throttle_remaining":remaining_by_market,"results":results}
+
+async def process_batch(market: str, batch: List[Tuple[int, dict]]) -> Tuple[List[dict], Any]:
+    """Sequencer handler: apply a batch of commands to the market's books on the loop and hand
+    the resulting SQL statements to the group-commit writer; returns (results, durable) where
+    `durable` completes after the commit and the trade/book events have been published"""
+    results=[]; trades=[]; touched=set(); ops: List[Tuple[str, tuple]] = []
+    for seq, cmd in batch:
+        try:
+            if cmd["op"] == "new":
+                results.append(apply_new_order(ops, market, seq, cmd, trades, touched))
+            elif cmd["op"] == "batch":
+                item_results = []
+                for oid, o in cmd["items"]:
+                    try:
+                        item_results.append(apply_new_order(ops, market, seq, {"order_id":oid,"user_key":cmd["user_key"],"order":o,"ts":cmd["ts"]}, trades, touched))
+                    except Exception as e:
+                        item_results.append(e)
+                results.append(item_results)
+            elif cmd["op"] == "cancel":
+                results.append(apply_cancel(ops, market, seq, cmd, touched))
+            elif cmd["op"] == "amend":
+                results.append(apply_amend(ops, market, seq, cmd, trades, touched))
+            elif cmd["op"] == "inject":
+                product = cmd["product"]
+                JOURNAL.append({"t":"inject","m":market,"p":product,"o":cmd["orders"]})
+                apply_inject(get_book(market, product), cmd["orders"])
+                persist_book(ops, market, product)
+                touched.add(product); results.append({"seq": seq})
+            else:
+                results.append(ValueError(f"unknown sequencer op {cmd['op']}"))
+        except Exception as e:
+            results.append(e)
+    # Deltas are cut per pass now, published in pass order once durable
+    deltas = [(product, get_book(market, product).take_delta()) for product in touched]
+    # Journal position covered by this pass, committed in the same transaction (reconcile_db)
+    if ops: ops.append(("UPDATE journal_state SET lsn = ? WHERE id = 1", (JOURNAL.lsn,)))
+    committed = get_writer(DB, commit_pass).submit(ops)
+    async def publish():
+        await committed
+        # Emit trade events, then one book update per touched product
+        for t in trades:
+            await emit_trade(t)
+        for product, delta in deltas:
+            if delta is not None: await emit_book(market, product, delta)
+    return results, publish()
+
+def commit_pass(con, ops: List[Tuple[str, tuple]]):
+    """DB executor: journal durable first (one fsync per group), then the group's statements in one transaction"""
+    JOURNAL.sync()
+    # Runs of the same statement go through executemany (one cached prepared statement)
+    try:
+        for sql, group in itertools.groupby(ops, key=lambda op: op[0]):
+            con.executemany(sql, [args for _, args in group])
+        con.commit()
+    except Exception:
+        con.rollback()  # nothing of a failed group may ride along with the next commit
+        raise
+
+def apply_new_order(ops, market: str, seq: int, cmd: dict, trades: List[dict], touched: set) -> dict:
+    o: OrderIn = cmd["order"]; oid = cmd["order_id"]
+    product = product_key(o.delivery_start, o.delivery_end)
+    taker = BookOrder(oid, cmd["user_key"], o.side, o.limit_price_eur_mwh, o.quantity_mwh, 0.0, cmd["ts"])
+    JOURNAL.append({"t":"new","m":market,"p":product,"id":oid,"u":taker.user_key,"s":o.side,"px":taker.price,"q":taker.qty,"ts":taker.ts,
+                    "ot":o.order_type,"tif":o.time_in_force,"ds":o.delivery_start,"de":o.delivery_end})
+    try_match_order(ops, market, product, taker, trades)
+    ops.append(("""INSERT INTO orders(id,user_key,market,side,type,tif,p_limit,qty,d_start,d_end,status,filled,ts)
+              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)""", (oid,taker.user_key,market,o.side,o.order_type,o.time_in_force,o.limit_price_eur_mwh,o.quantity_mwh,o.delivery_start,o.delivery_end,
+                                                      "FILLED" if taker.remaining <= EPS else "ACCEPTED",taker.filled,taker.ts)))
+    touched.add(product)
+    return {"order_id": oid, "seq": seq, "filled": taker.filled}
+
+def _resting(market: str, cmd: dict) -> Tuple[OrderBook, BookOrder]:
+    book = ORDER_INDEX.get(cmd["order_id"])
+    o = book.orders.get(cmd["order_id"]) if book is not None and book.market == market else None
+    if o is None: raise LookupError("order is no longer resting")
+    if o.user_key != cmd["user_key"]: raise PermissionError("order belongs to another user")
+    return book, o
+
+def apply_cancel(ops, market: str, seq: int, cmd: dict, touched: set) -> dict:
+    book, o = _resting(market, cmd)
+    JOURNAL.append({"t":"cancel","m":market,"p":book.product,"id":o.id})
+    book.remove(o.id)
+    ops.append(("UPDATE orders SET status = 'CANCELLED' WHERE id = ?", (o.id,)))
+    touched.add(book.product)
+    return {"order_id": o.id, "seq": seq, "status": "CANCELLED", "filled": o.filled}
+
+def apply_amend(ops, market: str, seq: int, cmd: dict, trades: List[dict], touched: set) -> dict:
+    book, o = _resting(market, cmd)
+    price = o.price if cmd.get("price") is None else float(cmd["price"])
+    qty = o.qty if cmd.get("qty") is None else float(cmd["qty"])
+    if qty - o.filled <= EPS: raise ValueError(f"quantity must exceed filled {o.filled}")
+    # Quantity reductions at the same price keep queue priority; anything else re-enters the book
+    keep = price == o.price and qty <= o.qty
+    ts = o.ts if keep else cmd["ts"]
+    JOURNAL.append({"t":"amend","m":market,"p":book.product,"id":o.id,"px":price,"q":qty,"ts":ts,"keep":keep})
+    if keep:
+        book.amend_qty(o.id, qty)
     else:
-        # For SELL: find BUY orders where bid_price >= limit_price
-        c.execute("""SELECT id, user_key, qty, p_limit FROM orders 
-                     WHERE market=? AND side=? AND status='ACCEPTED' AND filled < qty 
-                     AND p_limit >= ? ORDER BY p_limit DESC, ts ASC""", 
-                  (market, opposite_side, limit_price))
-    
-    matches = c.fetchall()
-    
-    remaining_qty = quantity
+        reprice(book, o.id, price, qty, ts)
+        try_match_order(ops, market, book.product, o, trades)
+    ops.append(("UPDATE orders SET p_limit = ?, qty = ?, filled = ?, status = ?, ts = ? WHERE id = ?",
+                (o.price, o.qty, o.filled, "FILLED" if o.remaining <= EPS else "ACCEPTED", o.ts, o.id)))
+    touched.add(book.product)
+    return {"order_id": o.id, "seq": seq, "status": "FILLED" if o.remaining <= EPS else "ACCEPTED",
+            "price": o.price, "quantity_mwh": o.qty, "filled": o.filled, "priority_kept": keep}
+
+def try_match_order(ops, market: str, product: str, taker: BookOrder, trades: List[dict]):
+    """Price-time-priority matching against the (market, product) book; SQLite only records the results
+    (statements are collected in `ops` and written by commit_pass)"""
+    book = get_book(market, product)
+    fills = book.match(taker)
+    # Unfilled remainder rests in the book
+    if taker.remaining > EPS:
+        book.add(taker)
     
-    for match in matches:
-        if remaining_qty <= 0:
-            break
-        
-        match_order_id = match["id"]
-        match_user_key = match["user_key"]
-        match_qty = match["qty"]
-        match_price = match["p_limit"]
-        
-        # How much can we trade?
-        c.execute("SELECT filled FROM orders WHERE id=?", (match_order_id,))
-        filled_row = c.fetchone()
-        filled_qty = float(filled_row["filled"] or 0) if filled_row else 0.0
-        match_available = match_qty - filled_qty
-        trade_qty = min(remaining_qty, match_available)
-        
+    now = datetime.utcnow().isoformat()
+    for maker, trade_qty in fills:
         # Average price for the trade
-        trade_price = (limit_price + match_price) / 2.0
-        
-        if trade_qty > 0:
-            # Create trade record
-            trade_id = uuid.uuid4().hex
-            now = datetime.utcnow().isoformat()
-            
-            c.execute("""INSERT INTO trades(id, order_id, user_key, executed, price, ts, market, side)
-                         VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
-                     (trade_id, new_order_id, match_user_key, trade_qty, trade_price, now, market, side))
-            
-            # Update new order filled qty
-            c.execute("""UPDATE orders SET filled = filled + ? WHERE id = ?""", (trade_qty, new_order_id))
-            
-            # Update matched order filled qty
-            c.execute("""UPDATE orders SET filled = filled + ? WHERE id = ?""", (trade_qty, match_order_id))
-            
-            # Update status if fully filled
-            c.execute("""UPDATE orders SET status = 'FILLED' WHERE id = ? AND filled >= qty""", (new_order_id,))
-            c.execute("""UPDATE orders SET status = 'FILLED' WHERE id = ? AND filled >= qty""", (match_order_id,))
-            
-            con.commit()
-            
-            # Emit trade event
-            await emit_trade({
-                "trade_id": trade_id,
-                "market": market,
-                "price": trade_price,
-                "quantity": trade_qty,
-                "side": side
-            })
-            
-            remaining_qty -= trade_qty
-    
-    con.close()
+        trade_price = (taker.price + maker.price) / 2.0
+        trade_id = uuid.uuid4().hex
+        # Carries the trade row and both orders' filled totals, so reconcile_db can rebuild them idempotently
+        JOURNAL.append({"t":"fill","m":market,"p":product,"maker":maker.id,"taker":taker.id,"q":trade_qty,
+                        "tid":trade_id,"px":trade_price,"ts":now,"s":taker.side,"mu":maker.user_key,"mf":maker.filled,"tf":taker.filled})
+        ops.append(("""INSERT INTO trades(id, order_id, user_key, executed, price, ts, market, side)
+                     VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (trade_id, taker.id, maker.user_key, trade_qty, trade_price, now, market, taker.side)))
+        if maker.user_key != INJECT_KEY:
+            ops.append(("UPDATE orders SET filled = ?, status = ? WHERE id = ?",
+                        (maker.filled, "FILLED" if maker.remaining <= EPS else "ACCEPTED", maker.id)))
+        trades.append({"trade_id": trade_id, "market": market, "product": product, "price": trade_price, "quantity": trade_qty, "side": taker.side})
+
+class OrderAmendIn(BaseModel):
+    quantity_mwh: Optional[float] = None
+    limit_price_eur_mwh: Optional[float] = None
+
+async def _book_of(order_id: str) -> OrderBook:
+    book = ORDER_INDEX.get(order_id)
+    if book is None:
+        row = await DB_READ.run(lambda con: con.execute("SELECT status FROM orders WHERE id=?", (order_id,)).fetchone())
+        if row is None: raise HTTPException(404, "order not found")
+        raise HTTPException(409, f"order is {row['status']}")
+    return book
+
+async def _submit_for_order(book: OrderBook, cmd: dict) -> dict:
+    try:
+        return await get_sequencer(book.market, process_batch).submit(cmd)
+    except LookupError as e: raise HTTPException(409, str(e))
+    except PermissionError as e: raise HTTPException(403, str(e))
+    except ValueError as e: raise HTTPException(400, str(e))
+
+@app.delete("/orders/{order_id}")
+async def cancel_order(order_id: str, user: User = Depends(get_user)):
+    book = await _book_of(order_id)
+    res = await _submit_for_order(book, {"op":"cancel","order_id":order_id,"user_key":user.api_key})
+    asyncio.create_task(emit_order(user.api_key, {"event":"CANCELLED",**res,"market":book.market}))
+    return res
+
+@app.patch("/orders/{order_id}")
+async def amend_order(order_id: str, a: OrderAmendIn, user: User = Depends(get_user)):
+    if a.quantity_mwh is None and a.limit_price_eur_mwh is None:
+        raise HTTPException(400, "nothing to amend")
+    book = await _book_of(order_id)
+    allow_buy, allow_sell, scale, soc, temp = soc_limits()
+    o = book.orders.get(order_id)
+    # Raising quantity or repricing adds exposure like a new order: same telemetry/SoC gates as create_order
+    if o is not None and ((a.quantity_mwh is not None and a.quantity_mwh > o.qty + EPS) or
+                          (a.limit_price_eur_mwh is not None and a.limit_price_eur_mwh != o.price)):
+        if BESS.stale(): raise HTTPException(503, STALE_MSG)
+        if o.side=="BUY" and not allow_buy:
+            raise HTTPException(400, f"BUY disabled at SoC {soc:.1f}% (<15%)")
+        if o.side=="SELL" and not allow_sell:
+            raise HTTPException(400, f"SELL disabled at SoC {soc:.1f}% (>90%)")
+    remaining = await throttle(user.api_key, book.market, scale)  # raises if over budget
+    res = await _submit_for_order(book, {"op":"amend","order_id":order_id,"user_key":user.api_key,"price":a.limit_price_eur_mwh,
+                                         "qty":a.quantity_mwh,"ts":datetime.utcnow().isoformat()})
+    asyncio.create_task(emit_order(user.api_key, {"event":"AMENDED",**res,"market":book.market}))
+    return {**res, "throttle_remaining": remaining}
 
 @app.get("/orders")
-def get_orders():
+async def get_orders():
     """Get all orders"""
-    con=db(); c=con.cursor()
+    return await DB_READ.run(_orders)
+
+def _orders(con):
+    """Read pool: query behind get_orders"""
+    c=con.cursor()
     c.execute("SELECT * FROM orders ORDER BY ts DESC LIMIT 100")
     orders = []
     for row in c.fetchall():
@@ -944,13 +1297,16 @@ def get_orders():
             "status": row["status"],
             "timestamp": row["ts"]
         })
-    con.close()
     return {"orders": orders}
 
 @app.get("/trades")
-def get_trades():
+async def get_trades():
     """Get all trades"""
-    con=db(); c=con.cursor()
+    return await DB_READ.run(_trades)
+
+def _trades(con):
+    """Read pool: query behind get_trades"""
+    c=con.cursor()
     c.execute("SELECT * FROM trades ORDER BY ts DESC LIMIT 100")
     trades = []
     for row in c.fetchall():
@@ -963,7 +1319,6 @@ def get_trades():
             "market": row["market"],
             "timestamp": row["ts"]
         })
-    con.close()
     return {"trades": trades}
 
 # ---- Metrics endpoint ----
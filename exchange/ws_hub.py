@@ -0,0 +1,173 @@
+"""
+WebSocket Hub - Per-connection outbound queues and subscription registry for the exchange streams
+Fan-out only enqueues; one writer task per connection does the (possibly slow) socket sends.
+Subscriptions are keyed by (market, product); product None means every product of the market.
+"""
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+Key = Tuple[str, Optional[str]]
+
+WS_QUEUE_MAX = int(os.getenv("WS_QUEUE_MAX", "256"))              # above this, book deltas are conflated
+WS_DISCONNECT_QUEUE = int(os.getenv("WS_DISCONNECT_QUEUE", "4096"))  # hard limit for never-dropped events
+WS_MAX_LAG_S = float(os.getenv("WS_MAX_LAG_S", "15"))              # oldest queued message older than this -> disconnect
+
+G_WS_CLIENTS = Gauge("pho_ws_clients", "Connected WebSocket clients", ["stream"])
+G_WS_MAX_LAG = Gauge("pho_ws_max_lag_seconds", "Age of the oldest queued message over all clients of a stream", ["stream"])
+H_WS_LAG = Histogram("pho_ws_send_lag_seconds", "Enqueue-to-send delay of outbound WebSocket messages", ["stream"],
+                     buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0))
+C_WS_CONFLATED = Counter("pho_ws_conflated_total", "Book deltas replaced by a resync snapshot for lagging clients", ["stream"])
+C_WS_DISCONNECTS = Counter("pho_ws_slow_disconnects_total", "Clients disconnected for exceeding queue/lag limits", ["stream"])
+
+CLIENTS: Set["Client"] = set()
+_ids = itertools.count(1)
+
+
+class Client:
+    """One connected socket: bounded outbound queue drained by its own writer task
+
+    Policy once the queue holds WS_QUEUE_MAX messages: book deltas are not queued;
+    the (market, product) is marked for resync and the writer sends a fresh snapshot
+    of the latest book instead. Trades and order events are never dropped; a client
+    whose queue reaches WS_DISCONNECT_QUEUE or lags more than WS_MAX_LAG_S is closed.
+    """
+
+    def __init__(self, ws, stream: str, send: Callable[[Any, Any], Awaitable[None]],
+                 snapshot: Optional[Callable[[str, Optional[str]], Any]] = None):
+        self.id = next(_ids)
+        self.ws = ws
+        self.stream = stream
+        self.send = send
+        self.snapshot = snapshot
+        self.q: deque = deque()
+        self.resync: Set[Key] = set()
+        self.sent = 0
+        self.conflated = 0
+        self.closed = False
+        self._wake = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        CLIENTS.add(self)
+        G_WS_CLIENTS.labels(stream).inc()
+
+    def lag(self) -> float:
+        return time.monotonic() - self.q[0][0] if self.q else 0.0
+
+    def push(self, item: Any, book_key: Optional[Key] = None) -> bool:
+        """Enqueue without blocking; returns False if the client is (now) closed"""
+        if self.closed:
+            return False
+        if book_key is not None and (book_key in self.resync or len(self.q) >= WS_QUEUE_MAX):
+            if book_key not in self.resync:
+                self.resync.add(book_key); self.conflated += 1
+                C_WS_CONFLATED.labels(self.stream).inc()
+            self._wake.set()
+            return True
+        self.q.append((time.monotonic(), item, book_key))
+        if len(self.q) >= WS_DISCONNECT_QUEUE or self.lag() > WS_MAX_LAG_S:
+            C_WS_DISCONNECTS.labels(self.stream).inc()
+            self.close()
+            return False
+        self._wake.set()
+        return True
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                if self.resync and self.snapshot is not None:
+                    key = self.resync.pop()
+                    # Queued deltas of this book are older than the snapshot: drop them
+                    self.q = deque(x for x in self.q if x[2] != key)
+                    await self.send(self.ws, self.snapshot(*key))
+                    continue
+                if not self.q:
+                    self._wake.clear()
+                    await self._wake.wait()
+                    continue
+                t0, item, book_key = self.q.popleft()
+                await self.send(self.ws, item)
+                self.sent += 1
+                H_WS_LAG.labels(self.stream).observe(time.monotonic() - t0)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.q.clear(); self.resync.clear()
+        CLIENTS.discard(self)
+        G_WS_CLIENTS.labels(self.stream).dec()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        asyncio.get_running_loop().create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try: await self.ws.close()
+        except Exception: pass
+
+    def info(self) -> Dict[str, Any]:
+        return {"id": self.id, "stream": self.stream, "queue": len(self.q), "lag_s": round(self.lag(), 4),
+                "sent": self.sent, "conflated": self.conflated, "resync_pending": len(self.resync)}
+
+
+def max_lag(stream: str) -> float:
+    return max((c.lag() for c in list(CLIENTS) if c.stream == stream), default=0.0)
+
+
+for _stream in ("book", "trades", "orders"):
+    G_WS_MAX_LAG.labels(_stream).set_function(lambda s=_stream: max_lag(s))
+
+
+def clients_info() -> List[Dict[str, Any]]:
+    return [c.info() for c in sorted(CLIENTS, key=lambda c: c.id)]
+
+
+class Subscriptions:
+    """Which clients want which (market, product); fan-out only touches interested clients"""
+
+    def __init__(self):
+        self.subs: Dict[Key, Set[Any]] = {}
+        self.of_ws: Dict[Any, Set[Key]] = {}
+
+    def subscribe(self, ws, market: str, product: Optional[str] = None):
+        key = (market, product or None)
+        self.subs.setdefault(key, set()).add(ws)
+        self.of_ws.setdefault(ws, set()).add(key)
+
+    def unsubscribe(self, ws, market: str, product: Optional[str] = None):
+        key = (market, product or None)
+        peers = self.subs.get(key)
+        if peers is not None:
+            peers.discard(ws)
+            if not peers: del self.subs[key]
+        keys = self.of_ws.get(ws)
+        if keys is not None:
+            keys.discard(key)
+
+    def drop(self, ws):
+        """Forget a client entirely (disconnect)"""
+        for market, product in list(self.of_ws.pop(ws, ())):
+            peers = self.subs.get((market, product))
+            if peers is not None:
+                peers.discard(ws)
+                if not peers: del self.subs[(market, product)]
+
+    def targets(self, market: str, product: str) -> Set[Any]:
+        """Clients subscribed to the whole market or to this product"""
+        whole = self.subs.get((market, None))
+        one = self.subs.get((market, product)) if product else None
+        if whole and one: return whole | one
+        return set(whole or one or ())
+
+    def count(self) -> int:
+        return len(self.of_ws)
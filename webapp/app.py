@@ -202,6 +202,18 @@ def get_market_data():
             "timestamp": datetime.now().isoformat()
         }
 
+def history_cache_headers():
+    """Forward the browser's If-None-Match so the exchange can answer 304 for unchanged history"""
+    tag = request.headers.get('If-None-Match')
+    return {'If-None-Match': tag} if tag else {}
+
+def history_proxy_response(response):
+    """Pass a cached exchange history response (200 or 304) through with its ETag"""
+    headers = {'ETag': response.headers.get('ETag', ''), 'Cache-Control': 'no-cache'}
+    if response.status_code == 304:
+        return '', 304, headers
+    return response.content, 200, {**headers, 'Content-Type': 'application/json'}
+
 @app.route('/api/market/history')
 def get_market_history():
     """Get market price history from server"""
@@ -212,10 +224,11 @@ def get_market_history():
         
         response = requests.get(
             f"{EXCHANGE_BASE_URL}/market/history",
-            params={'market': market, 'hours': hours, 'limit': limit}
+            params={'market': market, 'hours': hours, 'limit': limit},
+            headers=history_cache_headers()
         )
-        if response.status_code == 200:
-            return response.json()
+        if response.status_code in (200, 304):
+            return history_proxy_response(response)
         else:
             return {"market": market, "count": 0, "history": []}
     except Exception as e:
@@ -247,10 +260,11 @@ def get_longterm_history():
         
         response = requests.get(
             f"{EXCHANGE_BASE_URL}/market/history/longterm",
-            params={'market': market, 'days': days, 'aggregation': aggregation}
+            params={'market': market, 'days': days, 'aggregation': aggregation},
+            headers=history_cache_headers()
         )
-        if response.status_code == 200:
-            return response.json()
+        if response.status_code in (200, 304):
+            return history_proxy_response(response)
         else:
             return {"market": market, "days": days, "aggregation": aggregation, "count": 0, "history": []}
     except Exception as e: